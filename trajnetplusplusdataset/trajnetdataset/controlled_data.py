@@ -4,45 +4,64 @@ import random
 import argparse
 import os
 import itertools
+import multiprocessing
 
 import numpy as np
-from numpy.linalg import norm
 import matplotlib.pyplot as plt
 
 import rvo2
 import pickle
+import shutil
 import socialforce
 from socialforce.potentials import PedPedPotential
 from socialforce.fieldofview import FieldOfView
 
-def generate_circle_crossing(num_ped, sim=None, radius=4, mode=None): 
+from orca_helper import ORCA_PARAMS, ORCAPredictor, pref_velocities
+
+_ORCA_PREDICTOR = ORCAPredictor()
+
+def generate_circle_crossing(num_ped, sim=None, radius=4, mode=None, batch_size=64, max_batches=1000):
+    """ Place agents on a circle, goals diametrically opposite
+
+    Candidates are sampled in batches and rejected with a vectorized distance
+    check against the starts and goals of the agents already placed.
+    """
     positions = []
     goals = []
     speed = []
-    agent_list = []
+    min_dist = 0.8
     if mode == 'trajnet':
         radius = 10 ## 10 (TrajNet++)
-    for _ in range(num_ped):
-        while True:
-            angle = random.uniform(0, 1) * np.pi * 2
-            # add some noise to simulate all the possible cases robot could meet with human
-            px_noise = (random.uniform(0, 1) - 0.5)  ## human.v_pref
-            py_noise = (random.uniform(0, 1) - 0.5)  ## human.v_pref
-            px = radius * np.cos(angle) + px_noise
-            py = radius * np.sin(angle) + py_noise
-            collide = False
-            for agent in agent_list:
-                min_dist = 0.8
-                if mode == 'trajnet':
-                    min_dist = 2    ## min_dist ~ 2*human.radius + discomfort_dist ## 2 (TrajNet++)
-                if norm((px - agent[0], py - agent[1])) < min_dist or \
-                        norm((px - agent[2], py - agent[3])) < min_dist:
-                    collide = True
-                    break
-            if not collide:
+        min_dist = 2    ## min_dist ~ 2*human.radius + discomfort_dist ## 2 (TrajNet++)
+
+    ## starts and goals of placed agents
+    occupied = np.zeros((0, 2))
+    for _ in range(max_batches):
+        if len(positions) == num_ped:
+            break
+        angle = np.random.uniform(0, 1, batch_size) * np.pi * 2
+        # add some noise to simulate all the possible cases robot could meet with human
+        noise = np.random.uniform(0, 1, (batch_size, 2)) - 0.5  ## human.v_pref
+        candidates = radius * np.stack([np.cos(angle), np.sin(angle)], axis=1) + noise
+        if len(occupied):
+            dist = np.linalg.norm(candidates[:, np.newaxis] - occupied[np.newaxis], axis=-1)
+            candidates = candidates[dist.min(axis=1) >= min_dist]
+
+        ## remaining candidates only need a check against agents placed from this batch
+        batch_start = len(occupied)
+        for px, py in candidates.tolist():
+            if len(positions) == num_ped:
                 break
+            placed = occupied[batch_start:]
+            if len(placed) and np.min(np.linalg.norm(placed - (px, py), axis=1)) < min_dist:
+                continue
+            positions.append((px, py))
+            occupied = np.concatenate((occupied, [(px, py), (-px, -py)]))
+
+    if len(positions) < num_ped:
+        raise Exception('Could not place {} agents with min_dist {}'.format(num_ped, min_dist))
 
-        positions.append((px, py))
+    for px, py in positions:
         goals.append((-px, -py))
         if sim is not None:
             sim.addAgent((px, py))
@@ -50,12 +69,27 @@ def generate_circle_crossing(num_ped, sim=None, radius=4, mode=None):
         magnitude = np.linalg.norm(velocity)
         init_vel = 1 * velocity / magnitude if magnitude > 1 else velocity
         speed.append([init_vel[0], init_vel[1]])
-        agent_list.append([px, py, -px, -py])
     trajectories = [[positions[i]] for i in range(num_ped)]
     return trajectories, positions, goals, speed
 
-def generate_orca_trajectory(sim_scene, num_ped, min_dist=3, react_time=1.5, end_range=1.0, mode=None):
-    """ Simulating Scenario using ORCA """
+def is_sharp_turn(trajectory):
+    """
+    Check the last complete triple of a growing trajectory, so that checking
+    after every appended point covers exactly the triples of `are_smoothes`
+    """
+    if len(trajectory) < 4:
+        return False
+    p1, p2, p3 = np.array(trajectory[-4:-1])
+    return getAngle(p1, p2, p3) <= np.pi / 2
+
+def generate_orca_trajectory(sim_scene, num_ped, min_dist=3, react_time=1.5, end_range=1.0, mode=None,
+                             max_steps=6000, stall_steps=1000, stall_tolerance=0.1):
+    """ Simulating Scenario using ORCA
+
+    The scene is aborted (invalid) as soon as a sampled point creates a sharp
+    turn, an agent makes no progress of stall_tolerance towards its goal for
+    stall_steps steps, or max_steps is reached before all agents arrive.
+    """
     ## Default: (1 / 60., 1.5, 5, 1.5, 2, 0.4, 2)
     sampling_rate = 1
 
@@ -63,53 +97,93 @@ def generate_orca_trajectory(sim_scene, num_ped, min_dist=3, react_time=1.5, end
     if sim_scene == 'circle_crossing':
         fps = 100
         sampling_rate = fps / 2.5
-        sim = rvo2.PyRVOSimulator(1/fps, 10, 10, 5, 5, 0.3, 1)
+        sim = rvo2.PyRVOSimulator(1/fps, *ORCA_PARAMS['default'])
         if mode == 'trajnet':
-            sim = rvo2.PyRVOSimulator(1/fps, 4, 10, 4, 5, 0.6, 1.5) ## (TrajNet++)
-        trajectories, _, goals, speed = generate_circle_crossing(num_ped, sim, mode=mode)
+            sim = rvo2.PyRVOSimulator(1/fps, *ORCA_PARAMS['trajnet']) ## (TrajNet++)
+        trajectories, _, goals, _ = generate_circle_crossing(num_ped, sim, mode=mode)
     else:
         raise NotImplementedError
 
     # run
+    goals_array = np.array(goals)
+    arrived = np.zeros(num_ped, dtype=bool)
+    best_dist = np.linalg.norm(goals_array - np.array([t[0] for t in trajectories]), axis=1)
+    last_progress = np.zeros(num_ped)
     done = False
-    reaching_goal_by_ped = [False] * num_ped
     count = 0
     valid = True
+    for trajectory in trajectories:
+        trajectory.pop(0)
     ##Simulate a scene
-    while not done and count < 6000:
+    while not done and count < max_steps:
         count += 1
         sim.doStep()
-        reaching_goal = []
-        for i in range(num_ped):
-            if count == 1:
-                trajectories[i].pop(0)
-            position = sim.getAgentPosition(i)
-
-            ## Append only if Goal not reached
-            if not reaching_goal_by_ped[i]:
-                if count % sampling_rate == 0:
-                    trajectories[i].append(position)
-
-            # check if this agent reaches the goal
-            if np.linalg.norm(np.array(position) - np.array(goals[i])) < end_range:
-                reaching_goal.append(True)
-                sim.setAgentPrefVelocity(i, (0, 0))
-                reaching_goal_by_ped[i] = True
-            else:
-                reaching_goal.append(False)
-                velocity = np.array((goals[i][0] - position[0], goals[i][1] - position[1]))
-                speed = np.linalg.norm(velocity)
-                pref_vel = 1 * velocity / speed if speed > 1 else velocity
-                sim.setAgentPrefVelocity(i, tuple(pref_vel.tolist()))
-        done = all(reaching_goal)
-
-    if not done or not are_smoothes(trajectories):
+        positions = np.array([sim.getAgentPosition(i) for i in range(num_ped)])
+
+        ## Append only if Goal not reached
+        if count % sampling_rate == 0:
+            for i in np.flatnonzero(~arrived):
+                trajectories[i].append(tuple(positions[i].tolist()))
+                if is_sharp_turn(trajectories[i]):
+                    valid = False
+            if not valid:
+                break
+
+        # check which agents reach the goal; they get no further updates
+        velocity = goals_array - positions
+        dist = np.linalg.norm(velocity, axis=1)
+        reaching_goal = ~arrived & (dist < end_range)
+        for i in np.flatnonzero(reaching_goal):
+            sim.setAgentPrefVelocity(int(i), (0, 0))
+        arrived |= reaching_goal
+
+        ## stalled agents: no progress towards the goal for too long
+        progress = dist < best_dist - stall_tolerance
+        best_dist[progress] = dist[progress]
+        last_progress[progress] = count
+        if np.any(~arrived & (count - last_progress > stall_steps)):
+            valid = False
+            break
+
+        pref_vel = pref_velocities(velocity)
+        for i in np.flatnonzero(~arrived):
+            sim.setAgentPrefVelocity(int(i), tuple(pref_vel[i].tolist()))
+        done = arrived.all()
+
+    if not done:
         valid = False
 
     return trajectories, valid, goals
 
-def generate_sf_trajectory(sim_scene, num_ped, sf_params=[0.5, 2.1, 0.3], end_range=0.2):
-    """ Simulating Scenario using SF """
+class BlockSimulator(object):
+    """ Social force simulation of independent scenes advanced in lockstep
+
+    Every scene has its own socialforce.Simulator: forces are only computed
+    between pedestrians of the same scene (sum of n^2 pairs instead of
+    (sum of n)^2) and finished scenes are no longer stepped.
+    """
+    def __init__(self, initial_state, scene_index, **kwargs):
+        self.simulators = [socialforce.Simulator(initial_state[scene_index == k], **kwargs)
+                           for k in range(scene_index.max() + 1)]
+
+    @property
+    def state(self):
+        """ Packed state of all scenes (in scene order) """
+        return np.concatenate([sim.state for sim in self.simulators])
+
+    def step(self, scenes=None):
+        """ Advance the given scenes (default: all) by one step """
+        for k in (range(len(self.simulators)) if scenes is None else scenes):
+            self.simulators[k].step()
+        return self
+
+def generate_sf_trajectories(sim_scene, num_peds, sf_params=[0.5, 2.1, 0.3], end_range=0.2):
+    """ Simulating several Scenarios using SF, advanced in lockstep
+
+    Scenes whose pedestrians all reached their goals are frozen and no longer
+    recorded while the others keep running.
+    :return: list of (trajectories, count) per scene
+    """
     ## Default: (0.5, 2.1, 0.3)
     sampling_rate = 1
 
@@ -117,38 +191,49 @@ def generate_sf_trajectory(sim_scene, num_ped, sf_params=[0.5, 2.1, 0.3], end_ra
     if sim_scene == 'circle_crossing':
         fps = 10
         sampling_rate = fps / 2.5
-        trajectories, positions, goals, speed = generate_circle_crossing(num_ped)
+        scenes = [generate_circle_crossing(num_ped) for num_ped in num_peds]
     else:
         raise NotImplementedError
 
-    initial_state = np.array([[positions[i][0], positions[i][1], speed[i][0], speed[i][1],
-                               goals[i][0], goals[i][1]] for i in range(num_ped)])
+    trajectories = [scene[0] for scene in scenes]
+    initial_state = np.array([[px, py, vx, vy, gx, gy]
+                              for _, positions, goals, speed in scenes
+                              for (px, py), (gx, gy), (vx, vy) in zip(positions, goals, speed)])
+    scene_index = np.repeat(np.arange(len(num_peds)), num_peds)
+    ## flat view of the per-agent trajectory lists
+    agent_trajectories = [trajectory for scene in trajectories for trajectory in scene]
 
     ped_ped = PedPedPotential(1./fps, v0=sf_params[1], sigma=sf_params[2])
     field_of_view = FieldOfView()
-    s = socialforce.Simulator(initial_state, ped_ped=ped_ped, field_of_view=field_of_view,
-                              delta_t=1./fps, tau=sf_params[0])
+    s = BlockSimulator(initial_state, scene_index, ped_ped=ped_ped, field_of_view=field_of_view,
+                       delta_t=1./fps, tau=sf_params[0])
 
     # run
-    reaching_goal = [False] * num_ped
-    done = False
+    reaching_goal = np.zeros(len(scene_index), dtype=bool)
+    scene_done = np.zeros(len(num_peds), dtype=bool)
+    counts = np.zeros(len(num_peds), dtype=int)
     count = 0
 
-    #Simulate a scene
-    while not done and count < 500:
+    #Simulate the scenes
+    while not scene_done.all() and count < 500:
         count += 1
-        position = np.stack(s.step().state.copy())
-        for i in range(len(initial_state)):
-            if count % sampling_rate == 0:
-                trajectories[i].append((position[i, 0], position[i, 1]))
-            # check if this agent reaches the goal
-            if np.linalg.norm(position[i, :2] - np.array(goals[i])) < end_range:
-                reaching_goal[i] = True
-            else:
-                s.state[i, :4] = position[i, :4]
-        done = all(reaching_goal)
+        active = ~scene_done[scene_index]
+        s.step(np.flatnonzero(~scene_done))
+        counts[~scene_done] = count
 
-    return trajectories, count
+        position = s.state
+        if count % sampling_rate == 0:
+            for i in np.flatnonzero(active):
+                agent_trajectories[i].append((position[i, 0], position[i, 1]))
+        # check which agents reach the goal
+        reaching_goal |= np.linalg.norm(position[:, :2] - initial_state[:, 4:6], axis=1) < end_range
+        scene_done = np.bincount(scene_index, weights=~reaching_goal, minlength=len(num_peds)) == 0
+
+    return [(trajectories[k], counts[k]) for k in range(len(num_peds))]
+
+def generate_sf_trajectory(sim_scene, num_ped, sf_params=[0.5, 2.1, 0.3], end_range=0.2):
+    """ Simulating Scenario using SF """
+    return generate_sf_trajectories(sim_scene, [num_ped], sf_params, end_range)[0]
 
 
 def getAngle(a, b, c):
@@ -161,67 +246,121 @@ def getAngle(a, b, c):
     angle = np.arccos(cosine_angle)
     return angle
 
+def pad_trajectories(trajectories):
+    """
+    Stack trajectories of different lengths: N x T x 2 array (NaN padded), lengths
+    """
+    lengths = np.array([len(trajectory) for trajectory in trajectories], dtype=int)
+    paths = np.full((len(trajectories), lengths.max(initial=0), 2), np.nan)
+    for i, trajectory in enumerate(trajectories):
+        if lengths[i]:
+            paths[i, :lengths[i]] = np.asarray(trajectory)[:, :2]
+    return paths, lengths
+
+def find_sharp_turns(paths, lengths):
+    """
+    Indices (pedestrian, j) of all sharp turns at point j+1 of the padded paths
+    (same triples as `are_smoothes`: the last triple of a trajectory is not checked)
+    """
+    ba = paths[:, :-2] - paths[:, 1:-1]
+    bc = paths[:, 2:] - paths[:, 1:-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosine_angle = np.sum(ba * bc, axis=-1) / (np.linalg.norm(ba, axis=-1) * np.linalg.norm(bc, axis=-1))
+        angle = np.arccos(cosine_angle)
+    checked = np.arange(angle.shape[1])[np.newaxis] < (lengths[:, np.newaxis] - 3)
+    return np.nonzero(checked & (angle <= np.pi / 2))
+
+def find_collision_pairs(paths, lengths, max_steps, threshold=0.2):
+    """
+    Indices (timestep, ped_i, ped_j) with ped_i < ped_j of all pairs of the
+    padded paths closer than threshold
+    """
+    positions = np.swapaxes(paths[:, :max_steps], 0, 1)
+    present = np.arange(positions.shape[0])[:, np.newaxis] < lengths[np.newaxis]
+    distance = np.linalg.norm(positions[:, :, np.newaxis] - positions[:, np.newaxis], axis=-1)
+    pairs = present[:, :, np.newaxis] & present[:, np.newaxis] \
+            & np.triu(np.ones(distance.shape[1:], dtype=bool), k=1)
+    with np.errstate(invalid='ignore'):
+        return np.nonzero(pairs & (distance < threshold))
+
 def are_smoothes(trajectories):
     """
     Check if there is no sharp turns in the trajectories
     """
-    is_smooth = True
-    for i, _ in enumerate(trajectories):
-        trajectory = np.array(trajectories[i])
-        for j in range(0, len(trajectory[:, 0]) - 3):
-            p1 = np.array([trajectory[j, 0], trajectory[j, 1]])
-            p2 = np.array([trajectory[j+1, 0], trajectory[j+1, 1]])
-            p3 = np.array([trajectory[j+2, 0], trajectory[j+2, 1]])
-
-            angle = getAngle(p1, p2, p3)
-            if angle <= np.pi / 2:
-                is_smooth = False
-                # plt.scatter(p1[0], p1[1], color='red', marker='X')
-    return is_smooth
+    peds, _ = find_sharp_turns(*pad_trajectories(trajectories))
+    return len(peds) == 0
 
 def find_collisions(trajectories, max_steps):
     """
     Look for collisions in the trajectories
     """
-    for timestep in range(max_steps):
-        positions = []
-        for ped, _ in enumerate(trajectories):
-            traj = np.array(trajectories[ped])
-            if timestep < len(traj):
-                positions.append(traj[timestep])
-
-        # Check if distance between 2 points is smaller than 0.1m
-        # If yes -> collision detected
-        for combi in itertools.combinations(positions, 2):
-            distance = (np.linalg.norm(combi[0]-combi[1]))
-            if distance < 0.2:
-                return True
-
-    return False
-
-def write_to_txt(trajectories, path, count, frame, dict_dest=None, goals=None):
-    """ Write Trajectories to the text file """
+    # Check if distance between 2 points is smaller than 0.1m
+    # If yes -> collision detected
+    timesteps, _, _ = find_collision_pairs(*pad_trajectories(trajectories), max_steps=max_steps)
+    return len(timesteps) > 0
 
-    last_frame = 0
-    with open(path, 'a') as fo:
-        track_data = []
-        for i, _ in enumerate(trajectories):
-            for t, _ in enumerate(trajectories[i]):
+class TrajectoryWriter(object):
+    """ Writer kept open for a whole run of scenes
 
-                track_data.append('{}, {}, {}, {}'.format(t+frame, count+i,
-                                                          trajectories[i][t][0],
-                                                          trajectories[i][t][1]))
+    'txt': one 'frame, ped, x, y' line per point (same format as before)
+    'npz': frame, pedestrian, x, y columns saved as a single compressed
+           .npz file when the writer is closed
+    """
+    def __init__(self, path, output_format='txt', mode='w'):
+        if output_format not in ('txt', 'npz'):
+            raise NotImplementedError
+        self.path = path
+        self.output_format = output_format
+        self.columns = []
+        self.fo = None
+        if output_format == 'txt':
+            self.fo = open(path, mode, buffering=1 << 20)
+
+    def write(self, trajectories, count, frame, dict_dest=None, goals=None):
+        """ Write the trajectories of one scene, return its last frame """
+        paths, lengths = pad_trajectories(trajectories)
+        present = np.arange(paths.shape[1])[np.newaxis] < lengths[:, np.newaxis]
+        ped_index, t = np.nonzero(present)
+        frames = t + frame
+        peds = ped_index + count
+        xs, ys = paths[ped_index, t, 0], paths[ped_index, t, 1]
+
+        if self.output_format == 'txt':
+            self.fo.write(''.join('{}, {}, {}, {}\n'.format(*row)
+                                  for row in zip(frames.tolist(), peds.tolist(),
+                                                 xs.tolist(), ys.tolist())))
+        else:
+            self.columns.append((frames, peds, xs, ys))
 
-                if t == len(trajectories[i])-1 and t+frame > last_frame:
-                    last_frame = t+frame
-            if goals:
+        if goals:
+            for i, _ in enumerate(trajectories):
                 dict_dest[count+i] = goals[i]
 
-        for track in track_data:
-            fo.write(track)
-            fo.write('\n')
+        if not lengths.any():
+            return 0
+        return max(0, frame + lengths.max() - 1)
 
-    return last_frame
+    def close(self):
+        if self.fo is not None:
+            self.fo.close()
+            self.fo = None
+        elif self.output_format == 'npz':
+            frames, peds, xs, ys = [np.concatenate(c) for c in zip(*self.columns)] \
+                                   if self.columns else [np.zeros(0)] * 4
+            np.savez_compressed(self.path, frame=frames.astype(int), pedestrian=peds.astype(int),
+                                x=xs, y=ys)
+            self.columns = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def write_to_txt(trajectories, path, count, frame, dict_dest=None, goals=None):
+    """ Write Trajectories to the text file """
+    with TrajectoryWriter(path, mode='a') as writer:
+        return writer.write(trajectories, count, frame, dict_dest=dict_dest, goals=goals)
 
 def viz(trajectories, mode=None):
     """ Visualize Trajectories """
@@ -238,79 +377,55 @@ def viz(trajectories, mode=None):
     plt.close()
 
 def predict_all(input_paths, goals, n_predict=12):
+    """ ORCA (TrajNet++ parameters) from the observed paths (N x T x 2), pooled simulators """
+    return _ORCA_PREDICTOR.predict(input_paths, goals, pred_length=n_predict, mode='trajnet')
 
-    pred_length = n_predict
-
-    fps = 100
-    sampling_rate = fps / 2.5
+def sensitivity_deviations(trajectories, goals, iters=20, obs_start=10, obs_end=15, pred_len=12):
+    """ Deviations of ORCA re-predictions from perturbed observations
 
-    sim = rvo2.PyRVOSimulator(1/fps, 4, 10, 4, 5, 0.6, 1.5) ## (TrajNet++)
-    trajectories = [[input_paths[i][-1]] for i, _ in enumerate(input_paths)]
-    [sim.addAgent((p[-1][0],p[-1][1])) for p in input_paths]
-
-    num_ped = len(trajectories)
-    reaching_goal_by_ped = [False] * num_ped
-    count = 0
-    end_range = 1.0
-    done = False
-
-    for i in range(num_ped):
-        velocity = np.array((input_paths[i][-1][0] - input_paths[i][-3][0], input_paths[i][-1][1] - input_paths[i][-3][1]))
-        velocity = velocity/0.8
-        sim.setAgentVelocity(i, tuple(velocity.tolist()))
-
-        velocity = np.array((goals[i][0] - input_paths[i][-1][0], goals[i][1] - input_paths[i][-1][1]))
-        speed = np.linalg.norm(velocity)
-        pref_vel = 1 * velocity / speed if speed > 1 else velocity
-        sim.setAgentPrefVelocity(i, tuple(pref_vel.tolist()))
-
-    ##Simulate a scene
-    while (not done) and count < sampling_rate * pred_length + 1:
-        # print("Count: ", count)
-        count += 1
-        sim.doStep()
-        reaching_goal = []
-        for i in range(num_ped):
-            if count == 1:
-                trajectories[i].pop(0)
-            position = sim.getAgentPosition(i)
-
-            ## Append only if Goal not reached
-            if not reaching_goal_by_ped[i]:
-                if count % sampling_rate == 0:
-                    trajectories[i].append(position)
-
-            # check if this agent reaches the goal
-            if np.linalg.norm(np.array(position) - np.array(goals[i])) < end_range:
-                reaching_goal.append(True)
-                sim.setAgentPrefVelocity(i, (0, 0))
-                reaching_goal_by_ped[i] = True
-            else:
-                reaching_goal.append(False)
-                velocity = np.array((goals[i][0] - position[0], goals[i][1] - position[1]))
-                speed = np.linalg.norm(velocity)
-                pref_vel = 1 * velocity / speed if speed > 1 else velocity
-                sim.setAgentPrefVelocity(i, tuple(pref_vel.tolist()))
-
-        done = all(reaching_goal)
-
-    return trajectories
-
-def evaluate_sensitivity(trajectories, goals, mode=None, ade_thresh=0.11, fde_thresh=0.2, iters=20):
-    observation = np.array([trajectory[10:15] for trajectory in trajectories])
+    :return: ADE and FDE deviations (iters x N, NaN if nothing to compare),
+             list of the padded re-predicted scenes
+    """
+    observation = np.array([trajectory[obs_start:obs_end] for trajectory in trajectories])
     observation = np.round(observation, 2)
     goals = np.array(goals)
+    ground_truth, lengths = pad_trajectories([trajectory[obs_end:obs_end + pred_len]
+                                              for trajectory in trajectories])
 
+    num_ped = len(trajectories)
+    diff_ade = np.full((iters, num_ped), np.nan)
+    diff_fde = np.full((iters, num_ped), np.nan)
     trajectories_re_list = []
     for k in range(iters):
         observation_re = add_noise(observation.copy())
-        trajectories_re = predict_all(observation_re, goals)
-        for m, _ in enumerate(trajectories_re):
-            diff_ade =  np.mean(np.linalg.norm(np.array(trajectories[m][15:27]) - np.array(trajectories_re[m]), axis=1))
-            diff_fde =  np.linalg.norm(np.array(trajectories[m][26]) - np.array(trajectories_re[m][-1]))
-            if diff_ade > ade_thresh or diff_fde > fde_thresh:
-                print("INVALID", diff_ade, diff_fde)
-        trajectories_re_list.append(np.array(trajectories_re))
+        trajectories_re, lengths_re = pad_trajectories(predict_all(observation_re, goals, n_predict=pred_len))
+        trajectories_re_list.append(trajectories_re)
+
+        ## compare over the common prefix of ground truth and re-prediction
+        common = np.minimum(lengths, lengths_re)
+        steps = min(ground_truth.shape[1], trajectories_re.shape[1])
+        dist = np.linalg.norm(ground_truth[:, :steps] - trajectories_re[:, :steps], axis=-1)
+        compared = np.arange(steps)[np.newaxis] < common[:, np.newaxis]
+        has_common = common > 0
+        diff_ade[k, has_common] = (np.where(compared, dist, 0).sum(axis=1) / np.maximum(common, 1))[has_common]
+        diff_fde[k, has_common] = dist[has_common, common[has_common] - 1]
+
+    return diff_ade, diff_fde, trajectories_re_list
+
+def scene_sensitivity(trajectories, goals, ade_thresh=0.11, fde_thresh=0.2, iters=20,
+                      obs_start=10, obs_end=15, pred_len=12):
+    """ Pass (ORCA-insensitive scene) / fail and the deviations of a scene """
+    if min(len(trajectory) for trajectory in trajectories) < obs_end + pred_len:
+        return False, np.full((iters, len(trajectories)), np.nan), np.full((iters, len(trajectories)), np.nan)
+    diff_ade, diff_fde, _ = sensitivity_deviations(trajectories, goals, iters=iters, obs_start=obs_start,
+                                                   obs_end=obs_end, pred_len=pred_len)
+    passed = bool(np.all((diff_ade <= ade_thresh) & (diff_fde <= fde_thresh)))
+    return passed, diff_ade, diff_fde
+
+def evaluate_sensitivity(trajectories, goals, mode=None, ade_thresh=0.11, fde_thresh=0.2, iters=20):
+    diff_ade, diff_fde, trajectories_re_list = sensitivity_deviations(trajectories, goals, iters=iters)
+    for k, m in zip(*np.nonzero((diff_ade > ade_thresh) | (diff_fde > fde_thresh))):
+        print("INVALID", diff_ade[k, m], diff_fde[k, m])
 
     visualize_sensitivity(trajectories, trajectories_re_list, mode=mode)
 
@@ -351,25 +466,62 @@ def add_noise(observation):
     return observation
 
 def write_goals(filename, dict_dest):
-    # Make goal folders and write save goals (.pkl files)
+    # Save goals once (.pkl file) and reference it from the split folders
     if not os.path.isdir('./goal_files'):
         os.makedirs('./goal_files')
-
-    if not os.path.isdir('./goal_files/train'):
-        os.makedirs('./goal_files/train')
-    with open('goal_files/train/' + filename + '.pkl', 'wb') as f:
+    goal_file = 'goal_files/' + filename + '.pkl'
+    with open(goal_file, 'wb') as f:
         pickle.dump(dict_dest, f)
 
-    if not os.path.isdir('./goal_files/val'):
-        os.makedirs('./goal_files/val')
-    with open('goal_files/val/' + filename + '.pkl', 'wb') as f:
-        pickle.dump(dict_dest, f)
+    for split in ('train', 'val', 'test_private'):
+        if not os.path.isdir('./goal_files/' + split):
+            os.makedirs('./goal_files/' + split)
+        split_file = 'goal_files/' + split + '/' + filename + '.pkl'
+        if os.path.lexists(split_file):
+            os.remove(split_file)
+        try:
+            os.symlink(os.path.join('..', filename + '.pkl'), split_file)
+        except OSError:  ## no symlinks on this filesystem
+            shutil.copyfile(goal_file, split_file)
+
+def generate_scenes(task):
+    """ Generate a batch of scenes from one deterministic seed (pool worker) """
+    simulator, sim_scene, num_ped, mode, seed, num_scenes, max_steps, sensitivity = task
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+
+    min_dist, react_time = 1.5, 1.5
+    num_peds = [num_ped] * num_scenes
+    if mode == 'trajnet':
+        num_peds = [random.choice([4, 5, 6]) for _ in range(num_scenes)] ## TrajNet++
+
+    ##Generate scenes
+    scenes = []
+    if simulator == 'orca':
+        for num_ped in num_peds:
+            trajectories, valid, goals = generate_orca_trajectory(sim_scene=sim_scene,
+                                                                  num_ped=num_ped,
+                                                                  min_dist=min_dist,
+                                                                  react_time=react_time,
+                                                                  mode=mode,
+                                                                  max_steps=max_steps)
+            ## To evaluate sensitivity of ORCA
+            # evaluate_sensitivity(trajectories, goals, mode)
+            if valid and sensitivity is not None:
+                valid, _, _ = scene_sensitivity(trajectories, goals, *sensitivity)
+            scenes.append((trajectories, valid, goals, num_ped))
+
+    elif simulator == 'social_force':
+        sf_scenes = generate_sf_trajectories(sim_scene=sim_scene,
+                                             num_peds=num_peds,
+                                             sf_params=[0.5, 1.0, 0.1])
+        for (trajectories, _), num_ped in zip(sf_scenes, num_peds):
+            scenes.append((trajectories, True, None, num_ped))
+    else:
+        raise NotImplementedError
+
+    return scenes
 
-    if not os.path.isdir('./goal_files/test_private'):
-        os.makedirs('./goal_files/test_private')
-    with open('goal_files/test_private/' + filename + '.pkl', 'wb') as f:
-        pickle.dump(dict_dest, f)
-    
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--simulator', default='orca',
@@ -384,8 +536,27 @@ def main():
     parser.add_argument('--test', default=False)
     parser.add_argument('--mode', default=None,
                         help='Keep trajnet for trajnet dataset generation')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes generating scenes')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Base seed (the batch starting at scene i uses seed + i); random if not given')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='Scenes per task (social force scenes of a task are simulated together)')
+    parser.add_argument('--max_steps', type=int, default=6000,
+                        help='Step budget of a single ORCA scene')
+    parser.add_argument('--output_format', default='txt', choices=('txt', 'npz'),
+                        help='text file or compressed binary columns')
+    parser.add_argument('--sensitivity_filter', action='store_true',
+                        help='drop ORCA scenes sensitive to observation noise')
+    parser.add_argument('--ade_thresh', type=float, default=0.11,
+                        help='max ADE deviation for the sensitivity filter')
+    parser.add_argument('--fde_thresh', type=float, default=0.2,
+                        help='max FDE deviation for the sensitivity filter')
 
     args = parser.parse_args()
+    ## the sensitivity filter re-simulates with the TrajNet++ ORCA parameters
+    if args.sensitivity_filter and args.mode != 'trajnet':
+        parser.error('--sensitivity_filter requires --mode trajnet')
 
     np.seterr('ignore')
 
@@ -393,7 +564,10 @@ def main():
     num_scenes = args.num_scenes
     num_ped = args.num_ped
     mode = args.mode
-    min_dist, react_time = 1.5, 1.5
+    seed = args.seed
+    if seed is None:
+        seed = random.SystemRandom().randrange(2**32)
+    print('Seed: ', seed)
 
     if not os.path.isdir('./data'):
         os.makedirs('./data')
@@ -407,7 +581,7 @@ def main():
                   + args.simulation_scene + '_' \
                   + str(num_ped) + 'ped_' \
                   + str(num_scenes) + 'scenes_' \
-                  + '.txt'
+                  + '.' + args.output_format
     print(output_file)
 
     ## removes the file, if previously generated
@@ -419,40 +593,41 @@ def main():
 
     dict_dest = {}
 
-    for i in range(num_scenes):
-        if mode == 'trajnet':
-            num_ped = random.choice([4, 5, 6]) ## TrajNet++
+    ## Scenes are independent: generate them in any process, but assign
+    ## pedestrian ids and frame offsets in scene order
+    sensitivity = (args.ade_thresh, args.fde_thresh) if args.sensitivity_filter else None
+    tasks = [(args.simulator, args.simulation_scene, args.num_ped, mode, seed + i,
+              min(args.batch_size, num_scenes - i), args.max_steps, sensitivity)
+             for i in range(0, num_scenes, args.batch_size)]
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=np.seterr, initargs=('ignore',))
+        batches = pool.imap(generate_scenes, tasks)
+    else:
+        batches = map(generate_scenes, tasks)
+    scenes = itertools.chain.from_iterable(batches)
+
+    writer = TrajectoryWriter(output_file, output_format=args.output_format)
+    for i, (trajectories, valid, goals, num_ped) in enumerate(scenes):
         ## Print every 10th scene
         if (i+1) % 10 == 0:
             print(i)
 
-        ##Generate scenes
-        if args.simulator == 'orca':
-            trajectories, valid, goals = generate_orca_trajectory(sim_scene=args.simulation_scene,
-                                                                  num_ped=num_ped,
-                                                                  min_dist=min_dist,
-                                                                  react_time=react_time,
-                                                                  mode=mode)
-            ## To evaluate sensitivity of ORCA
-            # evaluate_sensitivity(trajectories, goals, mode)
-
-        elif args.simulator == 'social_force':
-            trajectories, valid = generate_sf_trajectory(sim_scene=args.simulation_scene,
-                                                         num_ped=num_ped,
-                                                         sf_params=[0.5, 1.0, 0.1])
-        else:
-            raise NotImplementedError
-
         ## Visualizing scenes
         # viz(trajectories, mode=mode)
 
         ## Write if the scene is valid
         if valid:
-            last_frame = write_to_txt(trajectories, output_file,
+            last_frame = writer.write(trajectories,
                                       count=count, frame=last_frame+5,
                                       dict_dest=dict_dest,
                                       goals=goals)
         count += num_ped
+    writer.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     ## Write Goal Dict of ORCA
     goal_filename = args.simulator + '_' \
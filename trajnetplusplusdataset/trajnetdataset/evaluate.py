@@ -0,0 +1,215 @@
+""" Score model predictions against TrajNet ground truth (ndjson files) """
+import argparse
+import itertools
+import json
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+
+import metrics
+import readers
+
+
+def read_rows(input_file):
+    """Stream TrackRows and SceneRows of a TrajNet ndjson file"""
+    with open(input_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = readers.get_trackrows(line)
+            if row is None:
+                row = readers.get_scenerows(line)
+            if row is not None:
+                yield row
+
+
+def read_ground_truth(input_file):
+    """Scenes by id and TrackRows grouped by pedestrian and by frame"""
+    scenes_by_id = {}
+    tracks_by_ped = defaultdict(list)
+    tracks_by_frame = defaultdict(list)
+    for row in read_rows(input_file):
+        if isinstance(row, readers.SceneRow):
+            scenes_by_id[row.scene] = row
+            continue
+        tracks_by_ped[row.pedestrian].append(row)
+        tracks_by_frame[row.frame].append(row)
+
+    for path in tracks_by_ped.values():
+        path.sort(key=lambda r: r.frame)
+    return scenes_by_id, tracks_by_ped, tracks_by_frame
+
+
+def read_predictions(input_file):
+    """Stream predicted TrackRows grouped by scene_id
+
+    Predictions of one scene are expected to be contiguous in the file,
+    as written by the TrajNet++ trajnet_tracks writer.
+    """
+    tracks = (row for row in read_rows(input_file) if isinstance(row, readers.TrackRow))
+    seen = set()
+    for scene_id, rows in itertools.groupby(tracks, key=lambda r: r.scene_id):
+        if scene_id in seen:
+            raise Exception('Predictions of scene {} are not contiguous in {}'.format(scene_id, input_file))
+        seen.add(scene_id)
+        yield scene_id, list(rows)
+
+
+def scene_jobs(ground_truth, predictions, obs_len=9, pred_len=12):
+    """Join predictions and ground truth by scene id into array jobs
+
+    Ground truth scenes without predictions get a job without predictions,
+    so that they are counted as missing.
+    """
+    scenes_by_id, tracks_by_ped, tracks_by_frame = ground_truth
+    predicted = set()
+    for scene_id, pred_rows in predictions:
+        scene = scenes_by_id.get(scene_id)
+        if scene is None:
+            continue
+        predicted.add(scene_id)
+
+        primary_path = [r for r in tracks_by_ped[scene.pedestrian]
+                        if scene.start <= r.frame <= scene.end]
+        pred_frames = [r.frame for r in primary_path][obs_len:obs_len + pred_len]
+        frame_index = {f: i for i, f in enumerate(pred_frames)}
+
+        ## ground truth primary: T x 2
+        gt = np.array([[r.x, r.y] for r in primary_path[obs_len:obs_len + pred_len]])
+
+        ## ground truth neighbours: T x N x 2 (NaN when absent)
+        neigh_ids = sorted({r.pedestrian for f in pred_frames for r in tracks_by_frame[f]
+                            if r.pedestrian != scene.pedestrian})
+        neigh_index = {p: i for i, p in enumerate(neigh_ids)}
+        neighbours = np.full((len(pred_frames), len(neigh_ids), 2), np.nan)
+        for f in pred_frames:
+            for r in tracks_by_frame[f]:
+                if r.pedestrian in neigh_index:
+                    neighbours[frame_index[f], neigh_index[r.pedestrian]] = (r.x, r.y)
+
+        ## predicted primary: K x T x 2 (NaN when missing)
+        modes = sorted({r.prediction_number or 0 for r in pred_rows
+                        if r.pedestrian == scene.pedestrian})
+        mode_index = {k: i for i, k in enumerate(modes)}
+        preds = np.full((len(modes), len(pred_frames), 2), np.nan)
+        for r in pred_rows:
+            if r.pedestrian == scene.pedestrian and r.frame in frame_index:
+                preds[mode_index[r.prediction_number or 0], frame_index[r.frame]] = (r.x, r.y)
+
+        ## plain tuples: TrajNet namedtuples cannot be pickled to the workers
+        yield scene.scene, scene.tag, gt, neighbours, preds
+
+    for scene_id, scene in scenes_by_id.items():
+        if scene_id not in predicted:
+            yield scene.scene, scene.tag, np.zeros((0, 2)), np.zeros((0, 0, 2)), np.zeros((0, 0, 2))
+
+
+def evaluate_scene(job, k_samples=3, n_samples=100):
+    """All metrics of a single scene"""
+    scene_id, tag, gt, neighbours, preds = job
+    pred_len = len(gt)
+    result = dict(scene=scene_id, tag=tag)
+
+    ## a scene without a complete primary prediction is only counted as
+    ## missing; other modes missing a predicted frame are not scored
+    complete = ~np.isnan(preds).any(axis=(1, 2))
+    if not len(preds) or pred_len == 0 or not complete[0]:
+        result.update(missing=1)
+        return result
+    preds = preds[complete]
+
+    ade, fde = metrics.batch_average_l2(preds[0], gt, pred_len), metrics.batch_final_l2(preds[0], gt)
+    result.update(ade=float(ade), fde=float(fde))
+
+    if len(preds) >= k_samples:
+        topk_ade, topk_fde = metrics.batch_topk(preds, gt, pred_len, k_samples)
+        result.update(topk_ade=float(topk_ade), topk_fde=float(topk_fde))
+
+    ## collision of primary prediction with ground truth neighbours
+    positions = np.concatenate((preds[0][:, np.newaxis], neighbours), axis=1)
+    collision_matrix, _ = metrics.scene_collisions(positions, n_predictions=pred_len)
+    result.update(col=float(collision_matrix[0].any()))
+
+    if len(preds) >= n_samples:
+        ll = metrics.batch_nll(preds[np.newaxis, :n_samples], gt[np.newaxis], pred_len)[0]
+        if not np.isnan(ll):
+            result.update(nll=float(ll))
+
+    return result
+
+
+def _evaluate_scene(args):
+    job, k_samples, n_samples = args
+    return evaluate_scene(job, k_samples, n_samples)
+
+
+METRICS = ('ade', 'fde', 'topk_ade', 'topk_fde', 'col', 'nll')
+
+
+def aggregate(results):
+    """Mean of every metric, overall and by interaction type (scene tag)"""
+    groups = defaultdict(list)
+    for result in results:
+        groups['all'].append(result)
+        tag = result['tag']
+        if isinstance(tag, (list, tuple)):
+            main_tag, sub_tags = tag[0], tag[1] if len(tag) > 1 else []
+        else:
+            main_tag, sub_tags = tag, []
+        groups['type_{}'.format(main_tag)].append(result)
+        for sub_tag in sub_tags:
+            groups['subtype_{}'.format(sub_tag)].append(result)
+
+    summary = {}
+    for name, group in sorted(groups.items()):
+        summary[name] = {'N': len(group), 'missing': sum(r.get('missing', 0) for r in group)}
+        for metric in METRICS:
+            values = [r[metric] for r in group if metric in r]
+            if values:
+                summary[name][metric] = float(np.mean(values))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gt', required=True,
+                        help='ground truth ndjson file')
+    parser.add_argument('--pred', required=True,
+                        help='prediction ndjson file')
+    parser.add_argument('--obs_len', type=int, default=9,
+                        help='Length of observation')
+    parser.add_argument('--pred_len', type=int, default=12,
+                        help='Length of prediction')
+    parser.add_argument('--k_samples', type=int, default=3,
+                        help='number of modes for Top-k ADE/FDE')
+    parser.add_argument('--n_samples', type=int, default=100,
+                        help='number of samples required for NLL')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of evaluation processes')
+    parser.add_argument('--chunksize', type=int, default=64,
+                        help='scenes sent to a worker at once')
+    parser.add_argument('--output', default=None,
+                        help='json file for aggregate and per-type results')
+    args = parser.parse_args()
+
+    ground_truth = read_ground_truth(args.gt)
+    jobs = ((job, args.k_samples, args.n_samples)
+            for job in scene_jobs(ground_truth, read_predictions(args.pred),
+                                  obs_len=args.obs_len, pred_len=args.pred_len))
+
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            results = list(pool.imap(_evaluate_scene, jobs, chunksize=args.chunksize))
+    else:
+        results = [_evaluate_scene(job) for job in jobs]
+
+    summary = aggregate(results)
+    print(json.dumps(summary, indent=2, allow_nan=False))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'summary': summary, 'scenes': results}, f, allow_nan=False)
+
+
+if __name__ == '__main__':
+    main()
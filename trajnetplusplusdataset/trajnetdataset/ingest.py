@@ -0,0 +1,136 @@
+""" Ingest directories of raw files (one file per track or per frame) into one column table """
+import argparse
+import concurrent.futures
+import fnmatch
+import multiprocessing
+import os
+from collections import Counter
+
+import numpy as np
+
+import readers
+
+
+def list_files(input_dir, pattern='*'):
+    """Sorted paths of all files below input_dir whose name matches pattern"""
+    return sorted(os.path.join(root, name)
+                  for root, _, names in os.walk(input_dir)
+                  for name in fnmatch.filter(names, pattern))
+
+
+def read_file(filename):
+    with open(filename, 'r') as f:
+        return filename, f.read()
+
+
+def parse_file(job):
+    """Columns of one file, with its (detected) format and id scope"""
+    filename, content, file_format = job
+    if file_format is None:
+        file_format = readers.detect_format(filename, content)
+    reader, id_scope = readers.FILE_FORMATS[file_format]
+    return file_format, id_scope, reader((filename, content))
+
+
+def concatenate(tables, frame_stride=1000000):
+    """Concatenate the per-file tables with globally unique ids.
+
+    Every 'global' scoped format and every file of a 'file' scoped format
+    gets its own block of frames (multiples of frame_stride, global formats
+    first), so that different datasets never share a frame. Pedestrians are
+    renumbered densely by (file, id) for 'file' scoped formats and by
+    (format, id) for 'global' scoped formats.
+    """
+    format_index = {name: i for i, name in enumerate(sorted(readers.FILE_FORMATS))}
+
+    def frame_block(max_frame):
+        return (max_frame // frame_stride + 1) * frame_stride
+
+    ## one frame offset per global format
+    global_max = {}
+    for file_format, id_scope, (f, _, _, _) in tables:
+        if id_scope == 'global' and len(f):
+            global_max[file_format] = max(global_max.get(file_format, 0), int(f.max()))
+    global_offset = {}
+    frame_offset = 0
+    for file_format in sorted(global_max):
+        global_offset[file_format] = frame_offset
+        frame_offset += frame_block(global_max[file_format])
+
+    frames, keys, peds, xs, ys = [], [], [], [], []
+    for file_index, (file_format, id_scope, (f, p, x, y)) in enumerate(tables):
+        if id_scope == 'global':
+            f = f + global_offset.get(file_format, 0)
+            key = -1 - format_index[file_format]
+        else:
+            if len(f):
+                f, frame_offset = f + frame_offset, frame_offset + frame_block(int(f.max()))
+            key = file_index
+        frames.append(f)
+        keys.append(np.full(len(p), key, dtype=np.int64))
+        peds.append(p)
+        xs.append(x)
+        ys.append(y)
+
+    if not frames:
+        return readers.trackrow_columns([])
+
+    keys = np.stack([np.concatenate(keys), np.concatenate(peds)], axis=1)
+    _, pedestrians = np.unique(keys, axis=0, return_inverse=True)
+    return (np.concatenate(frames), pedestrians.reshape(-1).astype(np.int64),
+            np.concatenate(xs), np.concatenate(ys))
+
+
+def ingest(files, file_format=None, workers=1, io_threads=8, chunksize=16):
+    """Read files in a thread pool, parse them in a process pool.
+
+    :param file_format: FILE_FORMATS name, or None to detect it per file
+    :return: frames, pedestrians, xs, ys of all files, and the files per format
+    """
+    ## fork the parsing processes before any reading thread is running
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        with concurrent.futures.ThreadPoolExecutor(io_threads) as io_pool:
+            jobs = ((filename, content, file_format)
+                    for filename, content in io_pool.map(read_file, files))
+            if pool is not None:
+                tables = list(pool.imap(parse_file, jobs, chunksize=chunksize))
+            else:
+                tables = [parse_file(job) for job in jobs]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    formats = Counter(table[0] for table in tables)
+    return concatenate(tables), formats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', required=True,
+                        help='directory of raw files')
+    parser.add_argument('--pattern', default='*',
+                        help='file name pattern')
+    parser.add_argument('--format', default=None, choices=sorted(readers.FILE_FORMATS),
+                        help='file format (auto-detected per file if not given)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of parsing processes')
+    parser.add_argument('--io_threads', type=int, default=8,
+                        help='number of file reading threads')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='files sent to a worker at once')
+    parser.add_argument('--output', required=True,
+                        help='.npz file with frame, pedestrian, x, y columns')
+    args = parser.parse_args()
+
+    files = list_files(args.input_dir, args.pattern)
+    (frames, pedestrians, xs, ys), formats = ingest(files, args.format, args.workers,
+                                                    args.io_threads, args.chunksize)
+    print('Files: ', dict(formats))
+    print('Rows: ', len(frames), 'Pedestrians: ', len(np.unique(pedestrians)))
+    np.savez_compressed(args.output, frame=frames, pedestrian=pedestrians, x=xs, y=ys)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,62 +1,167 @@
 """ Kalman filter Prediction """
 
 import numpy as np
-import pykalman
 from data import TrackRow
 
+TRANSITION_MATRIX = np.array([[1, 1, 0, 0],
+                              [0, 1, 0, 0],
+                              [0, 0, 1, 1],
+                              [0, 0, 0, 1]], dtype=float)
 
-def predict(paths, obs_len, pred_len, predict_all=False):
-    multimodal_outputs = {}
-    neighbours_tracks = []
+OBSERVATION_MATRIX = np.array([[1, 0, 0, 0],
+                               [0, 0, 1, 0]], dtype=float)
 
-    # Single Prediction
-    if not predict_all:
-        paths = paths[0:1]
 
-    for i, path in enumerate(paths):
-        path = paths[i]
-        initial_state_mean = [path[0].x, 0, path[0].y, 0]
+def _smooth(observations, transition_covariance, observation_covariance,
+            initial_state_mean, initial_state_covariance):
+    """Kalman filter + RTS smoother for N independent agents at once.
+
+    Same recursions as pykalman (filter, smooth, smooth_pair), with a leading
+    agent axis on every quantity.
+    :param observations: N x T x 2
+    :return: smoothed means (N x T x 4), covariances (N x T x 4 x 4),
+             pairwise covariances (N x T x 4 x 4, index 0 unused)
+    """
+    A, C = TRANSITION_MATRIX, OBSERVATION_MATRIX
+    num_agents, num_steps, _ = observations.shape
+
+    predicted_means = np.zeros((num_agents, num_steps, 4))
+    predicted_covs = np.zeros((num_agents, num_steps, 4, 4))
+    filtered_means = np.zeros((num_agents, num_steps, 4))
+    filtered_covs = np.zeros((num_agents, num_steps, 4, 4))
+
+    # filter
+    for t in range(num_steps):
+        if t == 0:
+            mean, cov = initial_state_mean, initial_state_covariance
+        else:
+            mean = filtered_means[:, t-1] @ A.T
+            cov = A @ filtered_covs[:, t-1] @ A.T + transition_covariance
+        predicted_means[:, t], predicted_covs[:, t] = mean, cov
+
+        innovation_cov = C @ cov @ C.T + observation_covariance
+        gain = cov @ C.T @ np.linalg.pinv(innovation_cov)
+        innovation = observations[:, t] - mean @ C.T
+        filtered_means[:, t] = mean + np.einsum('nij,nj->ni', gain, innovation)
+        filtered_covs[:, t] = cov - gain @ C @ cov
+
+    # smoother
+    smoothed_means = filtered_means.copy()
+    smoothed_covs = filtered_covs.copy()
+    pairwise_covs = np.zeros((num_agents, num_steps, 4, 4))
+    for t in reversed(range(num_steps - 1)):
+        gain = filtered_covs[:, t] @ A.T @ np.linalg.pinv(predicted_covs[:, t+1])
+        smoothed_means[:, t] += np.einsum('nij,nj->ni', gain,
+                                          smoothed_means[:, t+1] - predicted_means[:, t+1])
+        smoothed_covs[:, t] += gain @ (smoothed_covs[:, t+1] - predicted_covs[:, t+1]) \
+                               @ np.swapaxes(gain, -1, -2)
+        pairwise_covs[:, t+1] = smoothed_covs[:, t+1] @ np.swapaxes(gain, -1, -2)
+
+    return smoothed_means, smoothed_covs, pairwise_covs
+
+
+def fit(observations, n_iter=10):
+    """EM over noise covariances and initial state, independently per agent.
+
+    Mirrors pykalman's default `em_vars` so that the batched fit matches
+    `KalmanFilter.em` run on each agent separately.
+    :param observations: N x T x 2
+    :return: smoothed state means (N x T x 4) and the fitted parameters
+    """
+    A, C = TRANSITION_MATRIX, OBSERVATION_MATRIX
+    num_agents, num_steps, _ = observations.shape
+
+    params = dict(
+        transition_covariance=np.tile(1e-5 * np.eye(4), (num_agents, 1, 1)),
+        observation_covariance=np.tile(0.05**2 * np.eye(2), (num_agents, 1, 1)),
+        initial_state_mean=np.stack([observations[:, 0, 0], np.zeros(num_agents),
+                                     observations[:, 0, 1], np.zeros(num_agents)], axis=1),
+        initial_state_covariance=np.tile(np.eye(4), (num_agents, 1, 1)),
+    )
+
+    for _ in range(n_iter):
+        means, covs, pairwise_covs = _smooth(observations, **params)
+
+        err = observations - means @ C.T
+        params['observation_covariance'] = (
+            np.einsum('nti,ntj->nij', err, err) + (C @ covs @ C.T).sum(axis=1)
+        ) / num_steps
 
-        transition_matrix = [[1, 1, 0, 0],
-                             [0, 1, 0, 0],
-                             [0, 0, 1, 1],
-                             [0, 0, 0, 1]]
+        if num_steps > 1:
+            err = means[:, 1:] - means[:, :-1] @ A.T
+            cross = pairwise_covs[:, 1:] @ A.T
+            params['transition_covariance'] = (
+                np.einsum('nti,ntj->nij', err, err)
+                + (A @ covs[:, :-1] @ A.T).sum(axis=1)
+                + covs[:, 1:].sum(axis=1)
+                - cross.sum(axis=1)
+                - np.swapaxes(cross, -1, -2).sum(axis=1)
+            ) / (num_steps - 1)
 
-        observation_matrix = [[1, 0, 0, 0],
-                              [0, 0, 1, 0]]
+        params['initial_state_mean'] = means[:, 0]
+        params['initial_state_covariance'] = covs[:, 0]
 
-        kf = pykalman.KalmanFilter(transition_matrices=transition_matrix,
-                                   observation_matrices=observation_matrix,
-                                   transition_covariance=1e-5 * np.eye(4),
-                                   observation_covariance=0.05**2 * np.eye(2),
-                                   initial_state_mean=initial_state_mean)
-        # kf.em([(r.x, r.y) for r in path[:9]], em_vars=['transition_matrices',
-        #                                                'observation_matrices'])
+    means, _, _ = _smooth(observations, **params)
+    return means, params
 
-        kf.em([(r.x, r.y) for r in path[:obs_len]])
-        observed_states, _ = kf.smooth([(r.x, r.y) for r in path[:obs_len]])
 
-        # prepare predictions
+def _sqrtm(covariance):
+    """Symmetric square root of a stack of PSD matrices (tolerates singular ones)."""
+    eigval, eigvec = np.linalg.eigh(covariance)
+    return eigvec * np.sqrt(np.clip(eigval, 0, None))[..., np.newaxis, :]
+
+
+def predict_batch(observations, pred_len, n_samples=5):
+    """Fit and predict all agents of a scene in one batched operation.
+
+    The prediction is the average of `n_samples` trajectories sampled from
+    each agent's fitted filter, starting at its last smoothed state.
+    :param observations: N x obs_len x 2
+    :return: N x pred_len x 2
+    """
+    observations = np.asarray(observations, dtype=float)
+    means, params = fit(observations)
+    num_agents = observations.shape[0]
+
+    transition_noise = _sqrtm(params['transition_covariance'])
+    observation_noise = _sqrtm(params['observation_covariance'])
+
+    # first sample corresponds to last state
+    states = np.repeat(means[np.newaxis, :, -1], n_samples, axis=0)
+    predictions = np.zeros((num_agents, pred_len, 2))
+    for t in range(pred_len):
+        noise = np.random.standard_normal((n_samples, num_agents, 4))
+        states = states @ TRANSITION_MATRIX.T \
+                 + np.einsum('nij,snj->sni', transition_noise, noise)
+        noise = np.random.standard_normal((n_samples, num_agents, 2))
+        observed = states @ OBSERVATION_MATRIX.T \
+                   + np.einsum('nij,snj->sni', observation_noise, noise)
+        predictions[:, t] = observed.mean(axis=0)
+    return predictions
+
+
+def to_trackrows(predictions, paths, obs_len):
+    """Convert N x pred_len x 2 predictions into TrackRow lists, one per path."""
+    tracks = []
+    for path, prediction in zip(paths, predictions):
         frame_diff = path[1].frame - path[0].frame
         first_frame = path[obs_len - 1].frame + frame_diff
         ped_id = path[obs_len - 1].pedestrian
+        tracks.append([TrackRow(first_frame + j * frame_diff, ped_id, x, y)
+                       for j, (x, y) in enumerate(prediction.tolist())])
+    return tracks
 
-        # sample predictions (first sample corresponds to last state)
-        # average 5 sampled predictions
-        predictions = None
-        for _ in range(5):
-            _, pred = kf.sample(
-                pred_len + 1, initial_state=observed_states[-1])
-            if predictions is None:
-                predictions = pred
-            else:
-                predictions += pred
-        predictions /= 5.0
-        if i == 0:
-            primary_track = [TrackRow(first_frame + j * frame_diff, ped_id, x, y)
-                             for j, (x, y) in enumerate(predictions[1:])]
-        else:
-            neighbours_tracks.append([TrackRow(first_frame + j * frame_diff, ped_id, x, y)
-                                      for j, (x, y) in enumerate(predictions[1:])])
-    multimodal_outputs[0] = primary_track, neighbours_tracks
+
+def predict(paths, obs_len, pred_len, predict_all=False):
+    multimodal_outputs = {}
+
+    # Single Prediction
+    if not predict_all:
+        paths = paths[0:1]
+
+    observations = np.array([[(r.x, r.y) for r in path[:obs_len]] for path in paths])
+    predictions = predict_batch(observations, pred_len)
+
+    tracks = to_trackrows(predictions, paths, obs_len)
+    multimodal_outputs[0] = tracks[0], tracks[1:]
     return multimodal_outputs
@@ -1,6 +1,54 @@
 from __future__ import division
+from collections import defaultdict
+
 import numpy as np
-from scipy.stats import gaussian_kde
+from scipy.special import logsumexp
+
+
+def _xy(rows):
+    """TrackRows as a T x 2 array"""
+    return np.array([[r.x, r.y] for r in rows], dtype=float)
+
+
+def batch_l2(predictions, ground_truth, n_predictions=12):
+    """Per-timestep L2 errors of a batch of multimodal predictions.
+
+    :param predictions: B x K x T x 2 (or K x T x 2 / T x 2)
+    :param ground_truth: B x T x 2 (broadcast against predictions)
+    :return: B x K x n_predictions
+    """
+    predictions = np.asarray(predictions, dtype=float)[..., -n_predictions:, :]
+    ground_truth = np.asarray(ground_truth, dtype=float)[..., -n_predictions:, :]
+    if predictions.ndim == ground_truth.ndim + 1:
+        ground_truth = np.expand_dims(ground_truth, axis=-3)
+    return np.linalg.norm(predictions - ground_truth, axis=-1)
+
+
+def batch_final_l2(predictions, ground_truth):
+    """FDE of every mode of every scene: B x K"""
+    return batch_l2(predictions, ground_truth, n_predictions=1)[..., -1]
+
+
+def batch_average_l2(predictions, ground_truth, n_predictions=12):
+    """ADE of every mode of every scene: B x K"""
+    assert np.shape(predictions)[-2] >= n_predictions
+    assert np.shape(ground_truth)[-2] >= n_predictions
+    return batch_l2(predictions, ground_truth, n_predictions).mean(axis=-1)
+
+
+def batch_topk(predictions, ground_truth, n_predictions=12, k_samples=3):
+    """TopK ADE / FDE of every scene: two arrays of shape B
+
+    Among the first k_samples modes, the one closest to the GT in terms
+    of ADE is considered (first one on ties).
+    """
+    predictions = np.asarray(predictions, dtype=float)[..., :k_samples, :, :]
+    ade = batch_average_l2(predictions, ground_truth, n_predictions)
+    fde = batch_final_l2(predictions, ground_truth)
+    best = np.argmin(ade, axis=-1)[..., np.newaxis]
+    return (np.take_along_axis(ade, best, axis=-1)[..., 0],
+            np.take_along_axis(fde, best, axis=-1)[..., 0])
+
 
 def final_l2(path1, path2):
     row1 = path1[-1]
@@ -11,11 +59,8 @@ def final_l2(path1, path2):
 def average_l2(path1, path2, n_predictions=12):
     assert len(path1) >= n_predictions
     assert len(path2) >= n_predictions
-    path1 = path1[-n_predictions:]
-    path2 = path2[-n_predictions:]
-
-    return sum(np.linalg.norm((r1.x - r2.x, r1.y - r2.y))
-               for r1, r2 in zip(path1, path2)) / n_predictions
+    return float(batch_average_l2(_xy(path1[-n_predictions:]),
+                                  _xy(path2[-n_predictions:]), n_predictions))
 
 
 def collision(path1, path2, n_predictions=12, person_radius=0.1, inter_parts=2):
@@ -49,30 +94,125 @@ def collision(path1, path2, n_predictions=12, person_radius=0.1, inter_parts=2):
 
     return False
 
+def scene_collisions(positions, mask=None, n_predictions=12, person_radius=0.1, inter_parts=2):
+    """Check collisions between all pairs of agents of a scene at once
+
+    Same criterion as `collision`: consecutive positions are linearly
+    interpolated into (inter_parts + 1) points and two agents collide when
+    any pair of simultaneous points is closer than 2 * person_radius.
+    A segment is only checked if both agents are present at both ends.
+
+    :param positions: T x N x 2 (NaN for absent agents if no mask given)
+    :param mask: T x N boolean presence mask
+    :return: N x N boolean collision matrix,
+             N x N index of the first colliding segment (-1 if none)
+    """
+    positions = np.asarray(positions, dtype=float)[-n_predictions:]
+    if mask is None:
+        mask = ~np.isnan(positions).any(axis=-1)
+    mask = np.asarray(mask, dtype=bool)[-n_predictions:]
+    num_agents = positions.shape[1]
+
+    ## interpolated points: T-1 x Parts x N x 2
+    parts = np.linspace(0, 1, inter_parts + 1)[np.newaxis, :, np.newaxis, np.newaxis]
+    start, end = positions[:-1, np.newaxis], positions[1:, np.newaxis]
+    points = start + parts * (end - start)
+
+    ## pairwise distances of simultaneous points: T-1 x N x N
+    diff = points[:, :, :, np.newaxis] - points[:, :, np.newaxis]
+    min_dist = np.linalg.norm(diff, axis=-1).min(axis=1)
+
+    present = mask[:-1] & mask[1:]
+    valid = present[:, :, np.newaxis] & present[:, np.newaxis, :]
+    valid &= ~np.eye(num_agents, dtype=bool)
+    colliding = valid & (min_dist <= 2 * person_radius)
+
+    collision_matrix = colliding.any(axis=0)
+    first_collision = np.where(collision_matrix, colliding.argmax(axis=0), -1)
+    return collision_matrix, first_collision
+
+
 def topk(primary_tracks, ground_truth, n_predictions=12, k_samples=3):
     ## TopK multimodal
     ## The Prediction closest to the GT in terms of ADE is considered
 
-    l2 = 1e10
-    ## preds: Pred_len x Num_preds x 2
-    for pred_num in range(k_samples):
-        primary_prediction = [t for t in primary_tracks if t.prediction_number == pred_num]
-        tmp_score = average_l2(ground_truth, primary_prediction, n_predictions=n_predictions)
-        if tmp_score < l2:
-            l2 = tmp_score
-            topk_ade = tmp_score
-            topk_fde = final_l2(ground_truth, primary_prediction)
+    ## group predictions by prediction_number in a single pass
+    modes = defaultdict(list)
+    for t in primary_tracks:
+        modes[t.prediction_number].append((t.x, t.y))
+    ## preds: Num_preds x Pred_len x 2
+    preds = np.array([modes[pred_num][-n_predictions:] for pred_num in range(k_samples)])
+
+    topk_ade, topk_fde = batch_topk(preds, _xy(ground_truth), n_predictions, k_samples)
+    return float(topk_ade), float(topk_fde)
+
+def batch_nll(predictions, ground_truth, n_predictions=12, log_pdf_lower_bound=-20,
+              bw_method='scott'):
+    """Gaussian KDE log-likelihood of the GT for all scenes and timesteps at once
+
+    Equivalent to fitting `scipy.stats.gaussian_kde` on the samples of every
+    timestep, with the bandwidth, covariance and log-sum-exp vectorized.
+    Timesteps whose samples have a degenerate covariance (e.g. identical
+    predictions) or an unusable log-density are skipped.
+
+    :param predictions: B x Num_preds x T x 2
+    :param ground_truth: B x T x 2
+    :param bw_method: 'scott' or 'silverman'
+    :return: average log-likelihood per scene (B), NaN if no timestep is usable
+    """
+    preds = np.asarray(predictions, dtype=float)[..., -n_predictions:, :]
+    gt = np.asarray(ground_truth, dtype=float)[..., -n_predictions:, :]
+    n_samples, dim = preds.shape[1], preds.shape[-1]
+
+    if bw_method == 'scott':
+        factor = n_samples ** (-1. / (dim + 4))
+    elif bw_method == 'silverman':
+        factor = (n_samples * (dim + 2) / 4.) ** (-1. / (dim + 4))
+    else:
+        raise ValueError('Unknown bandwidth method {}'.format(bw_method))
+
+    ## kernel covariance: B x T x 2 x 2
+    centered = preds - preds.mean(axis=1, keepdims=True)
+    cov = np.einsum('bsti,bstj->btij', centered, centered) / (n_samples - 1)
+    cov *= factor ** 2
+
+    ## explicit handling of degenerate covariances
+    det = cov[..., 0, 0] * cov[..., 1, 1] - cov[..., 0, 1] * cov[..., 1, 0]
+    scale = np.trace(cov, axis1=-2, axis2=-1) ** 2
+    valid = det > np.finfo(float).eps * scale
+    det = np.where(valid, det, 1.0)
+    inv_cov = np.stack([np.stack([cov[..., 1, 1], -cov[..., 0, 1]], axis=-1),
+                        np.stack([-cov[..., 1, 0], cov[..., 0, 0]], axis=-1)], axis=-2)
+    inv_cov /= det[..., np.newaxis, np.newaxis]
+
+    ## log-density of the GT under every kernel: B x T x Num_preds
+    diff = gt[:, :, np.newaxis] - np.swapaxes(preds, 1, 2)
+    mahalanobis = np.einsum('btsi,btij,btsj->bts', diff, inv_cov, diff)
+    log_kernel = -0.5 * mahalanobis - 0.5 * np.log(det)[..., np.newaxis] \
+                 - 0.5 * dim * np.log(2 * np.pi)
+    log_pdf = logsumexp(log_kernel, axis=-1) - np.log(n_samples)
+    log_pdf = np.clip(log_pdf, a_min=log_pdf_lower_bound, a_max=None)
+
+    ## Difficulties in computing Gaussian_KDE
+    valid &= np.isfinite(log_pdf) & (log_pdf <= 100)
+    n_valid = valid.sum(axis=-1)
+    ll = np.where(valid, log_pdf, 0.0).sum(axis=-1)
+    return np.where(n_valid > 0, ll / np.maximum(n_valid, 1), np.nan)
 
-    return topk_ade, topk_fde
 
 def nll(primary_tracks, ground_truth, n_predictions=12, log_pdf_lower_bound=-20, n_samples=100):
     """
      Inspired from https://github.com/StanfordASL/Trajectron.
     """
 
-    gt = np.array([[t.x, t.y] for t in ground_truth][-n_predictions:])
+    gt = _xy(ground_truth)[-n_predictions:]
     frame_gt = [t.frame for t in ground_truth][-n_predictions:]
-    preds = np.array([[[t.x, t.y] for t in primary_tracks if t.frame == frame] for frame in frame_gt])
+
+    ## group predictions by frame in a single pass
+    preds_by_frame = defaultdict(list)
+    for t in primary_tracks:
+        preds_by_frame[t.frame].append((t.x, t.y))
+    preds = np.array([preds_by_frame[frame] for frame in frame_gt])
     ## preds: Pred_len x Num_preds x 2
 
     ## To verify atleast n_samples predictions
@@ -80,29 +220,9 @@ def nll(primary_tracks, ground_truth, n_predictions=12, log_pdf_lower_bound=-20,
         raise Exception('Need {} predictions'.format(n_samples))
     preds = preds[:, :n_samples]
 
-    pred_len = len(frame_gt)
-
-    ll = 0.0
-    same_pred = 0
-    for timestep in range(pred_len):
-        curr_gt = gt[timestep]
-        ## If identical prediction at particular time-step, skip
-        if np.all(preds[timestep][1:] == preds[timestep][:-1]):
-            same_pred += 1
-            continue    
-        try: 
-            scipy_kde = gaussian_kde(preds[timestep].T)
-            # We need [0] because it's a (1,)-shaped numpy array.
-            log_pdf = np.clip(scipy_kde.logpdf(curr_gt.T), a_min=log_pdf_lower_bound, a_max=None)[0]
-            if np.isnan(log_pdf) or np.isinf(log_pdf) or log_pdf > 100: ## Difficulties in computing Gaussian_KDE
-                same_pred += 1
-                continue
-            ll += log_pdf
-        except: ## Difficulties in computing Gaussian_KDE
-            same_pred += 1
-
-    if same_pred == pred_len:
+    ll = batch_nll(np.swapaxes(preds, 0, 1)[np.newaxis], gt[np.newaxis],
+                   n_predictions=len(frame_gt), log_pdf_lower_bound=log_pdf_lower_bound)[0]
+    if np.isnan(ll):
         raise Exception('All Predictions are Identical')
 
-    ll = ll / (pred_len - same_pred)
     return ll
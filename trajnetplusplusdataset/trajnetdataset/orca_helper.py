@@ -1,59 +1,103 @@
 import rvo2
 import numpy as np
 
-def predict_all(input_paths, goals, mode, pred_length):
-    fps = 100
-    sampling_rate = fps / 2.5
-    if mode == 'trajnet':
-        sim = rvo2.PyRVOSimulator(1/fps, 4, 10, 4, 5, 0.6, 1.5) ## (TrajNet++)
-    else:
-        sim = rvo2.PyRVOSimulator(1/fps, 10, 10, 5, 5, 0.3, 1) ## Default
-
-    # initialize
-    trajectories = [[(p[0], p[1])] for p in input_paths[-1]]
-    [sim.addAgent((p[0], p[1])) for p in input_paths[-1]]
-    num_ped = len(trajectories)
-
-    for i in range(num_ped):
-        velocity = np.array((input_paths[-1][i][0] - input_paths[-3][i][0], input_paths[-1][i][1] - input_paths[-3][i][1]))
-        velocity = velocity/0.8
-        sim.setAgentVelocity(i, tuple(velocity.tolist()))
-        velocity = np.array((goals[i][0] - input_paths[-1][i][0], goals[i][1] - input_paths[-1][i][1]))
-        speed = np.linalg.norm(velocity)
-        pref_vel = 1 * velocity / speed if speed > 1 else velocity
-        sim.setAgentPrefVelocity(i, tuple(pref_vel.tolist()))
-
-    reaching_goal_by_ped = [False] * num_ped
-    count = 0
-    end_range = 1.0
-    done = False
-    ##Simulate a scene
-    while count < sampling_rate * pred_length + 1:
-        count += 1
-        sim.doStep()
-        reaching_goal = []
+## neighborDist, maxNeighbors, timeHorizon, timeHorizonObst, radius, maxSpeed
+ORCA_PARAMS = {
+    'trajnet': (4, 10, 4, 5, 0.6, 1.5), ## (TrajNet++)
+    'default': (10, 10, 5, 5, 0.3, 1), ## Default
+}
+
+
+def pref_velocities(velocity, max_speed=1):
+    """ Preferred velocities towards the goals, capped at max_speed: N x 2 """
+    speed = np.linalg.norm(velocity, axis=-1, keepdims=True)
+    return np.where(speed > max_speed, max_speed * velocity / np.maximum(speed, 1e-12), velocity)
+
+
+class ORCAPredictor(object):
+    """ ORCA prediction service
+
+    Simulators are pooled by (mode, number of agents) and reset by setting
+    agent states instead of being rebuilt for every prediction.
+    """
+    def __init__(self, fps=100, end_range=1.0):
+        self.fps = fps
+        self.end_range = end_range
+        self.simulators = {}
+
+    def simulator(self, mode, num_ped):
+        key = (mode, num_ped)
+        if key not in self.simulators:
+            params = ORCA_PARAMS['trajnet' if mode == 'trajnet' else 'default']
+            sim = rvo2.PyRVOSimulator(1/self.fps, *params)
+            for _ in range(num_ped):
+                sim.addAgent((0, 0))
+            self.simulators[key] = sim
+        return self.simulators[key]
+
+    def predict(self, observations, goals, pred_length=12, mode='trajnet'):
+        """ Predict a single scene
+
+        :param observations: N x T x 2 observed positions (T >= 3)
+        :param goals: N x 2
+        :return: list of predicted positions per pedestrian
+        """
+        observations = np.asarray(observations, dtype=float)
+        goals = np.asarray(goals, dtype=float)
+        sampling_rate = self.fps / 2.5
+        num_ped = len(observations)
+        sim = self.simulator(mode, num_ped)
+
+        # reset
+        velocity = (observations[:, -1] - observations[:, -3]) / 0.8
+        pref_vel = pref_velocities(goals - observations[:, -1])
         for i in range(num_ped):
-            if count == 1:
-                trajectories[i].pop(0)
-            position = sim.getAgentPosition(i)
+            sim.setAgentPosition(i, tuple(observations[i, -1].tolist()))
+            sim.setAgentVelocity(i, tuple(velocity[i].tolist()))
+            sim.setAgentPrefVelocity(i, tuple(pref_vel[i].tolist()))
+
+        trajectories = [[] for _ in range(num_ped)]
+        arrived = np.zeros(num_ped, dtype=bool)
+        count = 0
+        ##Simulate a scene
+        while not arrived.all() and count < sampling_rate * pred_length + 1:
+            count += 1
+            sim.doStep()
+            positions = np.array([sim.getAgentPosition(i) for i in range(num_ped)])
 
             ## Append only if Goal not reached
-            if not reaching_goal_by_ped[i]:
-                if count % sampling_rate == 0:
-                    trajectories[i].append(position)
-
-            # check if this agent reaches the goal
-            if np.linalg.norm(np.array(position) - np.array(goals[i])) < end_range:
-                reaching_goal.append(True)
-                sim.setAgentPrefVelocity(i, (0, 0))
-                reaching_goal_by_ped[i] = True
-            else:
-                reaching_goal.append(False)
-                velocity = np.array((goals[i][0] - position[0], goals[i][1] - position[1]))
-                speed = np.linalg.norm(velocity)
-                pref_vel = 1 * velocity / speed if speed > 1 else velocity
-                sim.setAgentPrefVelocity(i, tuple(pref_vel.tolist()))
-
-    # states = np.array(trajectories[0])
-    # return states
-    return trajectories
\ No newline at end of file
+            if count % sampling_rate == 0:
+                for i in np.flatnonzero(~arrived):
+                    trajectories[i].append(tuple(positions[i].tolist()))
+
+            # check which agents reach the goal; they get no further updates
+            velocity = goals - positions
+            reaching_goal = ~arrived & (np.linalg.norm(velocity, axis=1) < self.end_range)
+            for i in np.flatnonzero(reaching_goal):
+                sim.setAgentPrefVelocity(int(i), (0, 0))
+            arrived |= reaching_goal
+
+            pref_vel = pref_velocities(velocity)
+            for i in np.flatnonzero(~arrived):
+                sim.setAgentPrefVelocity(int(i), tuple(pref_vel[i].tolist()))
+
+        return trajectories
+
+    def predict_batch(self, scenes, pred_length=12, mode='trajnet'):
+        """ Predict a batch of (observations, goals) scenes
+
+        Interface convenience only: scenes are predicted one after the other
+        on the pooled simulators (ORCA agents of one rvo2 simulator would
+        interact, so scenes are not stepped together).
+        """
+        return [self.predict(observations, goals, pred_length, mode)
+                for observations, goals in scenes]
+
+
+_PREDICTOR = ORCAPredictor()
+
+
+def predict_all(input_paths, goals, mode, pred_length):
+    """ input_paths: T x N x 2 observed positions (by frame) """
+    return _PREDICTOR.predict(np.swapaxes(np.asarray(input_paths, dtype=float), 0, 1),
+                              goals, pred_length, mode)
@@ -2,12 +2,21 @@
 
 import json
 import os
+import re
 import xml.etree.ElementTree
 
 import numpy as np
-import scipy.interpolate
+import scipy.linalg
 
-from trajnetplusplustools import TrackRow
+from trajnetplusplustools import SceneRow, TrackRow
+
+## Edinburgh: TRACK.R<id>=[[x y frame];[x y frame];...]
+EDINBURGH_TRACK = re.compile(r'^[ \t]*TRACK\.R([^=\n]*)=(.*)$', re.M)
+EDINBURGH_POINT = re.compile(r'(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)')
+
+## CFF: <date>T<hour>:<min>:<sec>:<ms>;PIW;<x>;<y>;<id> (morning and evening hours only)
+CFF_LINE = re.compile(r'^[^;:\n]*T(07|17):(\d+):(\d+):(\d)\d*;PIW;([^;\n]+);([^;\n]+);\s*(\d+)\s*;?\s*$',
+                      re.M)
 
 
 def biwi(line):
@@ -17,39 +26,112 @@ def biwi(line):
                     float(line[2]),
                     float(line[4]))
 
-def crowds_interpolate_person(ped_id, person_xyf):
-    ## Earlier
-    # xs = np.array([x for x, _, _ in person_xyf]) / 720 * 12 # 0.0167
-    # ys = np.array([y for _, y, _ in person_xyf]) / 576 * 12 # 0.0208
+def crowds_interpolate(points, offsets):
+    """Interpolate the control points of all persons at once.
+
+    Cubic (not-a-knot, as interp1d) splines for persons with more than 5
+    control points, linear otherwise, evaluated at every 10th frame.
+    The slopes of all cubic splines come from a single banded solve.
+    :param points: N x 3 control points (x, y, frame) of all persons
+    :param offsets: control points of person i are points[offsets[i]:offsets[i+1]]
+    :return: frames, pedestrians (int64), xs and ys (float64) column arrays
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    person = np.repeat(np.arange(len(lengths)), lengths)
+    order = np.lexsort((points[:, 2], person))
 
     ## Pixel-to-meter scale conversion according to
     ## https://github.com/agrimgupta92/sgan/issues/5
-    xs = np.array([x for x, _, _ in person_xyf]) * 0.0210
-    ys = np.array([y for _, y, _ in person_xyf]) * 0.0239
+    ## (earlier: x / 720 * 12, y / 576 * 12)
+    xy = points[order, :2] * (0.0210, 0.0239)
+    fs = points[order, 2]
+
+    ## segments between consecutive control points (dx = 1 across persons)
+    same_person = person[:-1] == person[1:]
+    dx = np.where(same_person, np.diff(fs), 1.0)
+    slope = np.diff(xy, axis=0) / dx[:, np.newaxis]
+
+    ## banded system for the spline slopes at every control point
+    ## (identity rows for the linearly interpolated persons)
+    index = np.arange(len(fs)) - offsets[person]
+    cubic = lengths[person] > 5
+    first = cubic & (index == 0)
+    last = cubic & (index == lengths[person] - 1)
+    inner = cubic & ~first & ~last
+
+    pad_dx = np.concatenate(([1.0, 1.0], dx, [1.0, 1.0]))
+    pad_slope = np.concatenate((np.zeros((2, 2)), slope, np.zeros((2, 2))))
+    dx_at = lambda shift: pad_dx[2 + shift:2 + shift + len(fs)]
+    slope_at = lambda shift: pad_slope[2 + shift:2 + shift + len(fs)]
+    dl, dr, sl, sr = dx_at(-1), dx_at(0), slope_at(-1), slope_at(0)
+
+    banded = np.zeros((3, len(fs)))
+    banded[1] = 1.0
+    rhs = np.zeros((len(fs), 2))
+
+    banded[1, inner] = 2 * (dl + dr)[inner]
+    banded[0, 1:][inner[:-1]] = dl[:-1][inner[:-1]]
+    banded[2, :-1][inner[1:]] = dr[1:][inner[1:]]
+    rhs[inner] = 3 * (dr[:, np.newaxis] * sl + dl[:, np.newaxis] * sr)[inner]
+
+    d = dr + dx_at(1)
+    banded[1, first] = dx_at(1)[first]
+    banded[0, 1:][first[:-1]] = d[:-1][first[:-1]]
+    rhs[first] = (((dr + 2 * d) * dx_at(1))[:, np.newaxis] * sr
+                  + (dr**2)[:, np.newaxis] * slope_at(1))[first] / d[first, np.newaxis]
+
+    d = dl + dx_at(-2)
+    banded[1, last] = dx_at(-2)[last]
+    banded[2, :-1][last[1:]] = d[1:][last[1:]]
+    rhs[last] = ((dl**2)[:, np.newaxis] * slope_at(-2)
+                 + ((2 * d + dl) * dx_at(-2))[:, np.newaxis] * sl)[last] / d[last, np.newaxis]
+
+    spline_slope = scipy.linalg.solve_banded((1, 1), banded, rhs) if len(fs) else rhs
+
+    ## output frames: every 10th frame strictly inside the control points
+    f_min = np.full(len(lengths), np.inf)
+    f_max = np.full(len(lengths), -np.inf)
+    np.minimum.at(f_min, person, fs)
+    np.maximum.at(f_max, person, fs)
+    valid = lengths > 0
+    f_start = np.where(valid, f_min // 10 * 10 + 10, 0)
+    counts = np.where(valid, np.maximum(np.ceil((f_max - f_start) / 10), 0), 0).astype(np.int64)
+    out_person = np.repeat(np.arange(len(lengths)), counts)
+    out_frames = f_start[out_person] + 10 * (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+
+    ## segment of every output frame
+    span = (fs.max() - fs.min() + 1) if len(fs) else 1
+    segment = np.searchsorted(person * span + fs, out_person * span + out_frames, side='right') - 1
+    segment = np.clip(segment, offsets[out_person], offsets[out_person] + lengths[out_person] - 2)
+
+    h = (out_frames - fs[segment])[:, np.newaxis]
+    seg_dx, seg_slope = dx[segment][:, np.newaxis], slope[segment]
+    s0, s1 = spline_slope[segment], spline_slope[segment + 1]
+    t = (s0 + s1 - 2 * seg_slope) / seg_dx
+    cubic_xy = xy[segment] + h * (s0 + h * ((seg_slope - s0) / seg_dx - t + h * t / seg_dx))
+    linear_xy = xy[segment] + h * seg_slope
+    out_xy = np.where(cubic[segment][:, np.newaxis], cubic_xy, linear_xy)
+
+    return out_frames.astype(np.int64), out_person, out_xy[:, 0], out_xy[:, 1]
 
-    fs = np.array([f for _, _, f in person_xyf])
 
-    kind = 'linear'
-    if len(fs) > 5:
-        kind = 'cubic'
-
-    x_fn = scipy.interpolate.interp1d(fs, xs, kind=kind)
-    y_fn = scipy.interpolate.interp1d(fs, ys, kind=kind)
-
-    frames = np.arange(min(fs) // 10 * 10 + 10, max(fs), 10)
+def crowds_interpolate_person(ped_id, person_xyf):
+    frames, _, xs, ys = crowds_interpolate(person_xyf, [0, len(person_xyf)])
     return [TrackRow(int(f), ped_id, x, y)
-            for x, y, f in np.stack([x_fn(frames), y_fn(frames), frames]).T]
+            for f, x, y in zip(frames.tolist(), xs.tolist(), ys.tolist())]
 
 
-def crowds(whole_file):
-    pedestrians = []
-    current_pedestrian = []
+def crowds_columns(whole_file):
+    """Control points of all persons as flat arrays, interpolated in one batch"""
+    points = []
+    offsets = [0]
     for line in whole_file.split('\n'):
         if '- Num of control points' in line or \
            '- the number of splines' in line:
-            if current_pedestrian:
-                pedestrians.append(current_pedestrian)
-            current_pedestrian = []
+            if len(points) > offsets[-1]:
+                offsets.append(len(points))
             continue
 
         # strip comments
@@ -62,35 +144,63 @@ def crowds(whole_file):
             continue
 
         x, y, f, _ = entries
-        current_pedestrian.append([float(x), float(y), int(f)])
+        points.append((float(x), float(y), int(f)))
 
-    if current_pedestrian:
-        pedestrians.append(current_pedestrian)
+    if len(points) > offsets[-1]:
+        offsets.append(len(points))
 
-    return [row
-            for i, p in enumerate(pedestrians)
-            for row in crowds_interpolate_person(i, p)]
+    return crowds_interpolate(points, offsets)
 
 
-def mot_xml(file_name):
-    """PETS2009 dataset.
+def crowds(whole_file):
+    return list(table_trackrows(crowds_columns(whole_file)))
 
-    Original frame rate is 7 frames / sec.
+
+def _columns(records):
+    """(frame, pedestrian, x, y) records as the column arrays of read_table"""
+    table = np.array(records, dtype=float).reshape(-1, 4)
+    return (table[:, 0].astype(np.int64), table[:, 1].astype(np.int64),
+            np.ascontiguousarray(table[:, 2]), np.ascontiguousarray(table[:, 3]))
+
+
+def mot_xml_columns(file_name, batch_size=10000):
+    """PETS2009 dataset, streamed in column batches.
+
+    Frame elements are parsed and cleared one at a time, so only the current
+    frame (and the empty shells of the previous ones) is held in memory.
+    Odd frames are skipped while parsing.
+    :return: generator of (frames, pedestrians, xs, ys) column arrays
     """
-    tree = xml.etree.ElementTree.parse(file_name)
-    root = tree.getroot()
-    for frame in root:
-        f = int(frame.attrib['number'])
-        if f % 2 != 0:  # reduce to 3.5 rows / sec
+    records = []
+    for _, element in xml.etree.ElementTree.iterparse(file_name, events=('end',)):
+        if element.tag != 'frame':
             continue
 
-        for ped in frame.find('objectlist'):
-            p = ped.attrib['id']
-            box = ped.find('box')
-            x = box.attrib['xc']
-            y = box.attrib['yc']
+        f = int(element.attrib['number'])
+        if f % 2 == 0:  # reduce to 3.5 rows / sec
+            for ped in element.find('objectlist'):
+                box = ped.find('box')
+                records.append((f, int(ped.attrib['id']),
+                                float(box.attrib['xc']) / 100.0, float(box.attrib['yc']) / 100.0))
 
-            yield TrackRow(f, int(p), float(x) / 100.0, float(y) / 100.0)
+        # release the processed frame
+        element.clear()
+
+        if len(records) >= batch_size:
+            yield _columns(records)
+            records = []
+
+    if records:
+        yield _columns(records)
+
+
+def mot_xml(file_name):
+    """PETS2009 dataset.
+
+    Original frame rate is 7 frames / sec.
+    """
+    for columns in mot_xml_columns(file_name):
+        yield from table_trackrows(columns)
 
 
 def mot(line):
@@ -106,6 +216,27 @@ def mot(line):
                     float(line[8]))
 
 
+def edinburgh_columns(filename_content_index):
+    """Edinburgh Informatics Forum data as column arrays.
+
+    All coordinate triples of all tracks are extracted with compiled
+    patterns; frame offset, downsampling and scaling act on the arrays.
+    """
+    (_, whole_file), index = filename_content_index
+
+    tracks = EDINBURGH_TRACK.findall(whole_file)
+    points = [EDINBURGH_POINT.findall(coordinates) for _, coordinates in tracks]
+    track_ids = np.repeat(np.array([int(track_id) for track_id, _ in tracks], dtype=np.int64),
+                          [len(p) for p in points])
+    xyf = np.array([point for track_points in points for point in track_points],
+                   dtype=float).reshape(-1, 3)
+
+    frames = xyf[:, 2].astype(np.int64) + index * 1000000
+    keep = frames % 3 == 0  # downsample frame rate
+    return (frames[keep], track_ids[keep] + index * 1000000,
+            xyf[keep, 0] * 0.0247, xyf[keep, 1] * 0.0247)
+
+
 def edinburgh(filename_content_index):
     """Edinburgh Informatics Forum data reader.
 
@@ -113,27 +244,7 @@ def edinburgh(filename_content_index):
     Every pixel corresponds to 24.7mm.
     http://homepages.inf.ed.ac.uk/rbf/FORUMTRACKING/
     """
-    (_, whole_file), index = filename_content_index
-
-    for line in whole_file.splitlines():
-        line = line.strip()
-        if not line.startswith('TRACK.R'):
-            continue
-
-        # get to track id
-        line = line[7:]
-        track_id, _, coordinates = line.partition('=')
-        track_id = int(track_id) + index * 1000000
-
-        # parse track
-        for coordinates in coordinates.split(';'):
-            if not coordinates:
-                continue
-            x, y, frame = coordinates.strip('[] ').split(' ')
-            frame = int(frame) + index * 1000000
-            if frame % 3 != 0:  # downsample frame rate
-                continue
-            yield TrackRow(frame, track_id, float(x) * 0.0247, float(y) * 0.0247)
+    return table_trackrows(edinburgh_columns(filename_content_index))
 
 
 def syi(filename_content):
@@ -175,6 +286,49 @@ def syi(filename_content):
         last_row = new_row
 
 
+def dukemtmc_columns(input_array, query_camera=5):
+    """DukeMTMC rows of one camera at every 24th frame, as column arrays.
+
+    Camera selection and frame subsampling are boolean masks over the
+    whole [camera, ID, frame, ..., worldX, worldY, ...] matrix.
+    """
+    input_array = np.asarray(input_array)
+    frames = input_array[:, 2].astype(np.int64)
+    mask = (input_array[:, 0].astype(np.int64) == query_camera) & (frames % 24 == 0)
+    return (frames[mask], input_array[mask, 1].astype(np.int64),
+            input_array[mask, 7].astype(float), input_array[mask, 8].astype(float))
+
+
+def dukemtmc_cameras(input_array, cameras=None, shard_dir=None):
+    """DukeMTMC column arrays of all (or the given) cameras in one pass.
+
+    :param shard_dir: if given, every camera is also written to
+                      shard_dir/camera<c>.npz (frame, pedestrian, x, y)
+    :return: dict camera -> (frames, pedestrians, xs, ys)
+    """
+    input_array = np.asarray(input_array)
+    frames = input_array[:, 2].astype(np.int64)
+    cams = input_array[:, 0].astype(np.int64)
+    mask = frames % 24 == 0
+    if cameras is not None:
+        mask &= np.isin(cams, cameras)
+
+    # rows by camera, in file order within every camera
+    keep = np.flatnonzero(mask)
+    keep = keep[np.argsort(cams[keep], kind='stable')]
+    camera_ids, starts = np.unique(cams[keep], return_index=True)
+
+    shards = {}
+    for camera, index in zip(camera_ids.tolist(), np.split(keep, starts[1:])):
+        shards[camera] = (frames[index], input_array[index, 1].astype(np.int64),
+                          input_array[index, 7].astype(float), input_array[index, 8].astype(float))
+        if shard_dir is not None:
+            np.savez(os.path.join(shard_dir, 'camera{}.npz'.format(camera)),
+                     frame=shards[camera][0], pedestrian=shards[camera][1],
+                     x=shards[camera][2], y=shards[camera][3])
+    return shards
+
+
 def dukemtmc(input_array, query_camera=5):
     """DukeMTMC dataset.
 
@@ -183,18 +337,7 @@ def dukemtmc(input_array, query_camera=5):
     Line format:
     [camera, ID, frame, left, top, width, height, worldX, worldY, feetX, feetyY]
     """
-    for line in input_array:
-        camera, person, frame, _, _, _, _, world_x, world_y, _, _ = line
-
-        camera = int(camera)
-        if camera != query_camera:
-            continue
-
-        frame = int(frame)
-        if frame % 24 != 0:
-            continue
-
-        yield TrackRow(frame, int(person), world_x, world_y)
+    return table_trackrows(dukemtmc_columns(input_array, query_camera))
 
 
 def wildtrack(filename_content):
@@ -258,6 +401,24 @@ def cff(line):
     return None
 
 
+def cff_columns(lines):
+    """CFF data of a whole file (or an iterable of lines) as column arrays.
+
+    Valid lines are matched with a compiled pattern; ids, frames,
+    downsampling and scaling are computed on the arrays as in cff.
+    """
+    if not isinstance(lines, str):
+        lines = '\n'.join(lines)
+    fields = np.array(CFF_LINE.findall(lines), dtype=str).reshape(-1, 7)
+
+    hour, minute, second, tenth, ped_id = fields[:, [0, 1, 2, 3, 6]].astype(np.int64).T
+    offset = np.where(hour == 17, 100000, 0)
+    frames = offset + minute * 1000 + second * 10 + tenth
+    keep = frames % 4 == 0
+    return (frames[keep], (offset + ped_id)[keep],
+            fields[keep, 4].astype(float) / 1000, fields[keep, 5].astype(float) / 1000)
+
+
 def lcas(line):
     line = [e for e in line.split(',') if e != '']
     return TrackRow(int(float(line[0])),
@@ -277,7 +438,15 @@ def get_trackrows(line):
     track = line.get('track')
     if track is not None:
         return TrackRow(track['f'], track['p'], track['x'], track['y'],
-                        track.get('prediction_number'))
+                        track.get('prediction_number'), track.get('scene_id'))
+    return None
+
+def get_scenerows(line):
+    line = json.loads(line)
+    scene = line.get('scene')
+    if scene is not None:
+        return SceneRow(scene['id'], scene['p'], scene['s'], scene['e'],
+                        scene.get('fps'), scene.get('tag'))
     return None
 
 def standard(line):
@@ -306,3 +475,102 @@ def car_data(filename_content):
             continue
 
         yield TrackRow(frame_id, int(id_), ratio * float(F1x), ratio * float(F1y))
+
+
+## Bulk readers for the delimiter-based formats:
+## delimiter (None: any whitespace) and columns of frame, pedestrian, x, y
+TABLE_FORMATS = {
+    'biwi': (None, (0, 1, 2, 4)),
+    'trajnet_original': (None, (0, 1, 2, 3)),
+    'mot': (',', (0, 1, 7, 8)),
+    'lcas': (',', (0, 1, 2, 3)),
+    'controlled': (',', (0, 1, 2, 3)),
+    'standard': ('\t', (0, 1, 2, 3)),
+}
+
+
+def read_table(source, table_format):
+    """Bulk reader for the formats in TABLE_FORMATS.
+
+    Parses a whole file (name or file object) or a chunk of lines at once,
+    with the same conversions as the line readers of the same name.
+    :return: frames and pedestrians (int64), xs and ys (float64) column arrays
+    """
+    delimiter, usecols = TABLE_FORMATS[table_format]
+    table = np.loadtxt(source, delimiter=delimiter, usecols=usecols, ndmin=2, dtype=float)
+    table = table.reshape(-1, 4)
+    if table_format == 'biwi':
+        table[:, 0] -= 1  # shift from 1-index to 0-index
+    return _columns(table)
+
+
+def table_trackrows(columns):
+    """Lazily iterate TrackRows over the column arrays of read_table."""
+    frames, pedestrians, xs, ys = columns
+    for i in range(len(frames)):
+        yield TrackRow(int(frames[i]), int(pedestrians[i]), float(xs[i]), float(ys[i]))
+
+
+def table_reader(table_format):
+    """Partition reader for pysparkling, e.g.
+    sc.textFile(path).mapPartitions(table_reader('mot'))"""
+    return lambda lines: table_trackrows(read_table(list(lines), table_format))
+
+
+def trackrow_columns(rows):
+    """Column arrays of an iterable of TrackRows"""
+    return _columns([(r.frame, r.pedestrian, r.x, r.y) for r in rows])
+
+
+## Registry of file formats: reader of a (filename, content) pair into column
+## arrays and scope of its ids ('file': frames and pedestrian ids are only
+## meaningful within one file, 'global': shared by all files of a dataset)
+FILE_FORMATS = {
+    'biwi': (lambda filename_content: read_table(filename_content[1].splitlines(), 'biwi'), 'file'),
+    'trajnet_original': (lambda filename_content: read_table(filename_content[1].splitlines(),
+                                                             'trajnet_original'), 'file'),
+    'mot': (lambda filename_content: read_table(filename_content[1].splitlines(), 'mot'), 'file'),
+    'lcas': (lambda filename_content: read_table(filename_content[1].splitlines(), 'lcas'), 'file'),
+    'controlled': (lambda filename_content: read_table(filename_content[1].splitlines(),
+                                                       'controlled'), 'file'),
+    'standard': (lambda filename_content: read_table(filename_content[1].splitlines(),
+                                                     'standard'), 'file'),
+    'crowds': (lambda filename_content: crowds_columns(filename_content[1]), 'file'),
+    'edinburgh': (lambda filename_content: edinburgh_columns((filename_content, 0)), 'file'),
+    'cff': (lambda filename_content: cff_columns(filename_content[1]), 'file'),
+    'syi': (lambda filename_content: trackrow_columns(syi(filename_content)), 'global'),
+    'wildtrack': (lambda filename_content: trackrow_columns(wildtrack(filename_content)), 'global'),
+    'car_data': (lambda filename_content: trackrow_columns(car_data(filename_content)), 'global'),
+}
+
+
+def detect_format(filename, content):
+    """Name of the FILE_FORMATS entry for a file, from its name and content"""
+    name = os.path.basename(filename)
+    if name.endswith('.vsp'):
+        return 'crowds'
+    if name.endswith('.json'):
+        return 'wildtrack'
+    if content.startswith('ID,Front1x'):
+        return 'car_data'
+    if 'TRACK.R' in content:
+        return 'edinburgh'
+    if ';PIW;' in content:
+        return 'cff'
+
+    first_line = next((line for line in content.splitlines() if line.strip()), '')
+    if '\t' in first_line:
+        return 'standard'
+    if ', ' in first_line:
+        return 'controlled'
+    if ',' in first_line:
+        return 'mot' if len(first_line.split(',')) >= 9 else 'lcas'
+
+    num_tokens = len(first_line.split())
+    if num_tokens == 1 and re.match(r'^\d+\.txt$', name):
+        return 'syi'
+    if num_tokens == 8:
+        return 'biwi'
+    if num_tokens == 4:
+        return 'trajnet_original'
+    raise Exception('Unknown file format: {}'.format(filename))
@@ -1,21 +1,42 @@
 """ Preparng Scenes for TrajNet """
+import copyreg
+import json
 import os
-from collections import defaultdict
+import shutil
 
+import numpy as np
 import trajnetplusplustools
-from trajnetplusplustools import SceneRow
+from trajnetplusplustools import SceneRow, TrackRow
+
+
+## TrajNet rows are namedtuples called 'Row' that pickle cannot find by name:
+## reduce them to plain tuples so that they can travel to and from pool workers
+def _scene_row(*fields):
+    return SceneRow(*fields)
+
+
+def _track_row(*fields):
+    return TrackRow(*fields)
+
+
+copyreg.pickle(SceneRow, lambda row: (_scene_row, tuple(row)))
+copyreg.pickle(TrackRow, lambda row: (_track_row, tuple(row)))
 
 
 class Scenes(object):
-    def __init__(self, fps, start_scene_id=0, args=None):
+    def __init__(self, fps, start_scene_id=0, args=None, close_radius=10.0, cell_size=None,
+                 partitions=1):
         self.scene_id = start_scene_id
         self.chunk_size = args.obs_len + args.pred_len
         self.chunk_stride = args.chunk_stride
         self.obs_len = args.obs_len
         self.visible_chunk = None
-        self.frames = set()
+        self.frames = np.zeros(0, dtype=np.int64)
         self.fps = fps
         self.min_length = args.min_length
+        self.close_radius = close_radius
+        self.cell_size = cell_size
+        self.partitions = partitions
 
     @staticmethod
     def euclidean_distance_2(row1, row2):
@@ -23,20 +44,62 @@ class Scenes(object):
         return (row1.x - row2.x)**2 + (row1.y - row2.y)**2
 
     @staticmethod
-    def close_pedestrians(rows, cell_size=10):
-        """Fast computation of spatially close pedestrians.
+    def close_rows(frames, peds, xs, ys, radius=10.0, cell_size=None):
+        """Spatial hash of all rows of all frames at once.
 
-        By frame, get the list of pedestrian ids that or close to other
-        pedestrians. Approximate with multi-occupancy of discrete grid cells.
+        Coordinates are floored into grid cells of cell_size (default: radius)
+        and every row is compared with the rows of the same frame in the
+        neighbouring cells that can be within radius (3x3 when
+        cell_size >= radius). Returns a boolean mask of the rows whose
+        pedestrian is within radius of another pedestrian in the same frame.
         """
-        sparse_occupancy = defaultdict(list)
-        for row in rows:
-            x = int(row.x // cell_size * cell_size)
-            y = int(row.y // cell_size * cell_size)
-            sparse_occupancy[(x, y)].append(row.pedestrian)
-        return {ped_id
-                for cell in sparse_occupancy.values() if len(cell) > 1
-                for ped_id in cell}
+        frames, peds = np.asarray(frames), np.asarray(peds)
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        close = np.zeros(len(frames), dtype=bool)
+        if not len(frames):
+            return close
+
+        cell_size = cell_size or radius
+        reach = int(np.ceil(radius / cell_size))
+        _, frame_rank = np.unique(frames, return_inverse=True)
+        cx = np.floor(xs / cell_size).astype(np.int64)
+        cy = np.floor(ys / cell_size).astype(np.int64)
+        cx -= cx.min() - reach
+        cy -= cy.min() - reach
+        width, height = cx.max() + reach + 1, cy.max() + reach + 1
+        cell = (frame_rank.astype(np.int64) * width + cx) * height + cy
+
+        order = np.argsort(cell, kind='stable')
+        cells, starts, counts = np.unique(cell[order], return_index=True, return_counts=True)
+
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                pos = np.searchsorted(cells, cells + dx * height + dy)
+                pos = np.minimum(pos, len(cells) - 1)
+                found = np.flatnonzero(cells[pos] == cells + dx * height + dy)
+                if not len(found):
+                    continue
+
+                # all row pairs between cell a and neighbouring cell b
+                a, b = found, pos[found]
+                n_pairs = counts[a] * counts[b]
+                pair_cell = np.repeat(np.arange(len(a)), n_pairs)
+                within = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+                i = order[starts[a][pair_cell] + within // counts[b][pair_cell]]
+                j = order[starts[b][pair_cell] + within % counts[b][pair_cell]]
+
+                hit = (peds[i] != peds[j]) & \
+                      ((xs[i] - xs[j])**2 + (ys[i] - ys[j])**2 <= radius**2)
+                close[i[hit]] = True
+        return close
+
+    @staticmethod
+    def close_pedestrians(rows, radius=10.0, cell_size=None):
+        """Ids of the pedestrians within radius of another pedestrian (rows of one frame)."""
+        rows = list(rows)
+        close = Scenes.close_rows([r.frame for r in rows], [r.pedestrian for r in rows],
+                                  [r.x for r in rows], [r.y for r in rows], radius, cell_size)
+        return {r.pedestrian for r, c in zip(rows, close) if c}
 
     @staticmethod
     def continuous_frames(frames, tolerance=1.5):
@@ -50,57 +113,130 @@ class Scenes(object):
 
         return ok
 
+    @staticmethod
+    def frame_arrays(frames, peds, close):
+        """Compact per-frame statistics from row columns and the close-row mask.
+
+        Returns sorted frames, counts by frame index and the close pedestrians
+        of frame index i as occupancy_ids[occupancy_ptr[i]:occupancy_ptr[i+1]].
+        """
+        unique_frames, counts = np.unique(frames, return_counts=True)
+        close_frames, close_ids = np.unique(
+            np.stack((frames[close], peds[close]), axis=1).reshape(-1, 2), axis=0).T
+        occupancy_ptr = np.searchsorted(close_frames, unique_frames, side='left')
+        occupancy_ptr = np.append(occupancy_ptr, len(close_ids))
+        return unique_frames, counts, occupancy_ptr, close_ids
+
+    @staticmethod
+    def continuous_windows(frames, starts, chunk_size, tolerance=1.5):
+        """Vectorized continuous_frames for the windows frames[s:s+chunk_size]."""
+        increments = np.lib.stride_tricks.sliding_window_view(np.diff(frames), chunk_size - 1)[starts]
+        median_increment = np.partition(increments, (chunk_size - 1) // 2, axis=1)[:, (chunk_size - 1) // 2]
+        return median_increment * tolerance > increments.max(axis=1)
+
+    @staticmethod
+    def rolling_sum(values, starts, window):
+        """Sums of values[s:s+window] for all start offsets s."""
+        cumulative = np.concatenate(([0], np.cumsum(values)))
+        return cumulative[starts + window] - cumulative[starts]
+
+    def scene_windows(self, ped_id, path, frames, counts, close_keys, ped_offset):
+        """Start offsets of the valid scene windows of one pedestrian.
+
+        Returns the sorted frames of the pedestrian and the start offsets s
+        of the windows frames[s:s+chunk_size] passing all filters.
+        """
+        path = sorted(path, key=lambda p: p.frame)
+        ped_frames = np.array([r.frame for r in path], dtype=np.int64)
+        xy = np.array([(r.x, r.y) for r in path], dtype=float)
+        starts = np.arange(0, len(path) - self.chunk_size + 1, self.chunk_stride)
+        ends = starts + self.chunk_size - 1
+
+        # filter for pedestrians moving by more than min_length meter
+        keep = ((xy[starts] - xy[ends])**2).sum(axis=1) > self.min_length
+
+        # filter out scenes with large gaps in frame numbers
+        keep &= self.continuous_windows(ped_frames, starts, self.chunk_size)
+
+        # filter for scenes that have some activity
+        frame_index = np.searchsorted(frames, ped_frames)
+        keep &= self.rolling_sum(counts[frame_index], starts, self.chunk_size) >= 2.0 * self.chunk_size
+
+        # require some proximity to other pedestrians
+        keys = frame_index * ped_offset[1] + (ped_id - ped_offset[0])
+        is_close = np.isin(keys, close_keys)
+        keep &= self.rolling_sum(is_close, starts, self.chunk_size) > 0
+
+        return ped_frames, starts[keep]
+
     def from_rows(self, rows):
-        count_by_frame = rows.groupBy(lambda r: r.frame).mapValues(len).collectAsMap()
-        occupancy_by_frame = (rows
-                              .groupBy(lambda r: r.frame)
-                              .mapValues(self.close_pedestrians)
-                              .collectAsMap())
-
-        def to_scene_row(ped_frames):
-            ped_id, scene_frames = ped_frames
-            row = SceneRow(self.scene_id, ped_id, scene_frames[0], scene_frames[-1], self.fps, 0)
+        # counts and close pedestrians of all frames from one pass over the rows
+        columns = np.array(rows.map(lambda r: (r.frame, r.pedestrian, r.x, r.y)).collect(),
+                           dtype=float).reshape(-1, 4)
+        row_frames, row_peds = columns[:, 0].astype(np.int64), columns[:, 1].astype(np.int64)
+        close = self.close_rows(row_frames, row_peds, columns[:, 2], columns[:, 3],
+                                self.close_radius, self.cell_size)
+        frames, counts, occupancy_ptr, occupancy_ids = self.frame_arrays(row_frames, row_peds, close)
+
+        # close (frame index, pedestrian) pairs as sorted integer keys
+        ped_offset = (row_peds.min(initial=0), row_peds.max(initial=0) - row_peds.min(initial=0) + 1)
+        close_frame_index = np.repeat(np.arange(len(frames)), np.diff(occupancy_ptr))
+        close_keys = close_frame_index * ped_offset[1] + (occupancy_ids - ped_offset[0])
+
+        def to_scene_row(ped_window):
+            ped_id, start, end = ped_window
+            row = SceneRow(self.scene_id, ped_id, start, end, self.fps, 0)
             self.scene_id += 1
             return row
 
-        # scenes: pedestrian of interest, [frames]
+        def visible_frames(ped_windows):
+            _, (ped_frames, starts) = ped_windows
+            visible = self.chunk_size if self.visible_chunk is None else self.visible_chunk
+            covered = np.zeros(len(ped_frames) + 1, dtype=np.int64)
+            np.add.at(covered, starts, 1)
+            np.add.at(covered, np.minimum(starts + visible, len(ped_frames)), -1)
+            return ped_frames[np.cumsum(covered[:-1]) > 0]
+
+        # scenes: pedestrian of interest, (sorted frames, window start offsets)
+        # windows are evaluated per pedestrian partition (in the pool of the context)
         scenes = (
             rows
-            .groupBy(lambda r: r.pedestrian)
+            .groupBy(lambda r: r.pedestrian, self.partitions)
             .filter(lambda p_path: len(p_path[1]) >= self.chunk_size)
-            .mapValues(lambda path: sorted(path, key=lambda p: p.frame))
-            .flatMapValues(lambda path: [
-                [path[ii].frame for ii in range(i, i + self.chunk_size)]
-                for i in range(0, len(path) - self.chunk_size + 1, self.chunk_stride)
-                # filter for pedestrians moving by more than min_length meter
-                if self.euclidean_distance_2(path[i], path[i+self.chunk_size-1]) > self.min_length
-            ])
-
-            # filter out scenes with large gaps in frame numbers
-            .filter(lambda ped_frames: self.continuous_frames(ped_frames[1]))
-
-            # filter for scenes that have some activity
-            .filter(lambda ped_frames:
-                    sum(count_by_frame[f] for f in ped_frames[1]) >= 2.0 * self.chunk_size)
-
-            # require some proximity to other pedestrians
-            .filter(lambda ped_frames:
-                    ped_frames[0] in {p
-                                      for frame in ped_frames[1]
-                                      for p in occupancy_by_frame[frame]})
-
-            .cache()
+            .map(lambda p_path: (p_path[0], self.scene_windows(p_path[0], p_path[1], frames, counts,
+                                                               close_keys, ped_offset)))
+            .filter(lambda ped_windows: len(ped_windows[1][1]))
+            .collect()
         )
 
-        self.frames |= set(scenes
-                           .flatMap(lambda ped_frames:
-                                    ped_frames[1]
-                                    if self.visible_chunk is None
-                                    else ped_frames[1][:self.visible_chunk])
-                           .toLocalIterator())
+        # visible frames of this output only, as a sorted array
+        self.frames = np.unique(np.concatenate(
+            [np.zeros(0, dtype=np.int64)] + [visible_frames(ped_windows) for ped_windows in scenes]))
+
+        # scene ids are assigned in the driver, in scene order
+        scene_rows = []
+        for ped_windows in scenes:
+            ped_id, (ped_frames, starts) = ped_windows
+            scene_rows += [to_scene_row((ped_id, int(ped_frames[s]),
+                                         int(ped_frames[s + self.chunk_size - 1])))
+                           for s in starts]
+
+        return rows.context.parallelize(scene_rows, self.partitions)
 
-        return scenes.map(to_scene_row)
+    def frame_bounds(self):
+        """First frame of every frame range after the first one, with equally
+        many visible frames per range."""
+        return np.array([chunk[0] for chunk in np.array_split(self.frames, self.partitions)[1:]
+                         if len(chunk)], dtype=np.int64)
 
+    @staticmethod
+    def select_tracks(partition_rows, frames, bounds):
+        """Rows of a partition in the (sorted) frames, keyed by frame range."""
+        partition_rows = list(partition_rows)
+        row_frames = np.array([r.frame for r in partition_rows], dtype=np.int64)
+        keep = np.flatnonzero(np.isin(row_frames, frames))
+        ranges = np.searchsorted(bounds, row_frames[keep], side='right')
+        return [(int(index), partition_rows[i]) for index, i in zip(ranges, keep)]
 
     def rows_to_file(self, rows, output_file):
         if '/test/' in output_file:
@@ -109,14 +245,73 @@ class Scenes(object):
         else:
             self.visible_chunk = None
         scenes = self.from_rows(rows)
-        tracks = rows.filter(lambda r: r.frame in self.frames)
-        all_data = rows.context.union((scenes, tracks))
+        frames, bounds = self.frames, self.frame_bounds()
+
+        ## scenes by start frame and tracks by frame, in the same frame ranges
+        all_data = rows.context.union((
+            scenes.map(lambda s: (int(np.searchsorted(bounds, s.start, side='right')), s)),
+            rows.mapPartitions(lambda partition_rows: self.select_tracks(partition_rows, frames, bounds)),
+        )).partitionBy(len(bounds) + 1, lambda index: index)
 
         ## removes the file, if previously generated
-        if os.path.isfile(output_file):
+        if os.path.isdir(output_file):
+            shutil.rmtree(output_file)
+        elif os.path.isfile(output_file):
             os.remove(output_file)
+        shard_dir = output_file + '.shards'
+        if os.path.isdir(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.makedirs(shard_dir)
+
+        ## every partition writes its own shard, then the shards are merged
+        shards = all_data.mapPartitionsWithIndex(
+            lambda index, partition_rows: [write_shard(shard_dir, index, partition_rows)]
+        ).collect()
+        write_manifest(shard_dir, output_file, shards)
+        merge_shards(shard_dir)
 
-        ## write scenes and tracks
-        all_data.map(trajnetplusplustools.writers.trajnet).saveAsTextFile(output_file)
+        ## the frame selection only applies to this output
+        self.frames = np.zeros(0, dtype=np.int64)
 
         return self
+
+
+def write_shard(shard_dir, index, partition_rows):
+    """Write the scenes and tracks of one partition, returns its manifest entry."""
+    shard = dict(index=index,
+                 scenes='scenes-{:05d}.ndjson'.format(index), num_scenes=0,
+                 tracks='tracks-{:05d}.ndjson'.format(index), num_tracks=0)
+    with open(os.path.join(shard_dir, shard['scenes']), 'w') as scene_file, \
+         open(os.path.join(shard_dir, shard['tracks']), 'w') as track_file:
+        for _, row in partition_rows:
+            if isinstance(row, SceneRow):
+                scene_file.write(trajnetplusplustools.writers.trajnet(row) + '\n')
+                shard['num_scenes'] += 1
+            else:
+                track_file.write(trajnetplusplustools.writers.trajnet(row) + '\n')
+                shard['num_tracks'] += 1
+    return shard
+
+
+def write_manifest(shard_dir, output_file, shards):
+    """Merge manifest: the output file and its shards in merge order."""
+    manifest = dict(output=output_file, shards=sorted(shards, key=lambda shard: shard['index']))
+    with open(os.path.join(shard_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def merge_shards(shard_dir, remove=True):
+    """Concatenate the shards of a manifest: all scenes first, then all tracks."""
+    with open(os.path.join(shard_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+
+    with open(manifest['output'], 'w') as output:
+        for key in ('scenes', 'tracks'):
+            for shard in manifest['shards']:
+                with open(os.path.join(shard_dir, shard[key]), 'r') as f:
+                    shutil.copyfileobj(f, output)
+
+    if remove:
+        shutil.rmtree(shard_dir)
+    return manifest